@@ -0,0 +1,347 @@
+"""
+Time the hot paths of the device code under CPython and check them for regressions.
+
+Runs the code in pico/ on the simulator's fake machine, os and uasyncio modules
+(see sim/hal.py) in a scratch directory, and measures for each case the time per
+call and the heap it allocates (peak and retained bytes, from tracemalloc).  Times
+are also given relative to a fixed calibration loop, so a baseline recorded on one
+computer can be checked on another.
+
+    python bench/bench.py
+    python bench/bench.py --filter check_schedule
+    python bench/bench.py --save bench/baseline.json
+    python bench/bench.py --check bench/baseline.json --threshold 1.5
+
+With --check the exit status is 1 if a case got slower than threshold times its
+baseline by more than --floor microseconds, or allocates more than --mem-threshold
+times its baseline peak.  Each time is the best of several runs spread over a few
+rounds of all the cases, as the noise of a busy computer only ever adds time.  The
+time ratios are taken relative to the calibration and then to their median over
+all the cases, as a computer can run the whole benchmark slower than another (or
+than itself a minute ago) by more than its calibration shows.  As a change that
+slows most cases alike only shows in the median, a median above the threshold is
+a regression too.  A case (or the median) that looks slower in one run only counts
+as a regression if it is also slower in a second run of all the cases.
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sim"))
+import hal
+from simulate import random_config
+
+DOMAIN_COUNTS = [1, 10, 100, 1000]
+COMMANDS = ["help", "info", "print_config", "history 10", "queue", "stats", "mem", "log 20",
+            "print_time", "boot", "water domain0; stop domain0"]
+# Domains of the system the commands run on
+COMMAND_DOMAINS = 100
+# Records in the history file for the append cases
+HISTORY_SIZES = [100, 1000, 10000]
+# Files in the directory for the exists cases
+DIRECTORY_SIZES = [10, 100, 1000]
+# Timed runs of each case in each of ROUNDS rounds over all the cases, the best one counts
+REPEATS = 1
+ROUNDS = 7
+# Time ratios are only taken relative to their median if at least this share of the
+# baseline cases ran (e.g. not with --filter)
+MEDIAN_SHARE = 0.5
+
+
+class NullWriter:
+    """Session writer that only counts the output"""
+    def __init__(self):
+        self.size = 0
+
+    def write(self, s):
+        self.size += len(s)
+
+
+def bench_config(ndomains):
+    """The simulator's random configuration, with gpios that exist on a Pico"""
+    config = random_config(ndomains, random.Random(1))
+    for (i, d) in enumerate(config["domains"]):
+        d["gpio"] = i % 26
+    return config
+
+
+def quiet_time(ws):
+    """localtime tuple of a Tuesday minute when no domain of ws is due, so check_schedule
+       only checks (or the minute with the fewest due domains)"""
+    best = None
+    for minute in range(0, 1440, 7):
+        t = hal.mktime((2024, 4, 2, minute // 60, minute % 60, 0))
+        dt = hal.localtime(t)
+        due = sum(1 for d in ws.domains.values() if d.is_due(dt))
+        if best is None or due < best[0]:
+            best = (due, dt)
+        if not due:
+            break
+    return best[1]
+
+
+def calibrate():
+    """Nanoseconds for a fixed mix of the operations the device code does"""
+    def work():
+        d = {}
+        for i in range(2000):
+            d["k{}".format(i % 50)] = i * 3 // 7
+        return sorted(d.values())
+    return measure_time(work)
+
+
+def measure_time(op, repeats=REPEATS, min_time=0.01):
+    """Best time of op in ns out of repeats runs of enough calls to last min_time seconds"""
+    # Like timeit, keep the garbage collector from running at random points of the runs
+    gc.disable()
+    try:
+        return best_time(op, repeats, min_time)
+    finally:
+        gc.enable()
+
+
+def best_time(op, repeats, min_time):
+    op()
+    n = 1
+    while True:
+        start = time.perf_counter_ns()
+        for i in range(n):
+            op()
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= min_time * 1e9 or n >= 1 << 20:
+            break
+        n *= 2
+    best = elapsed
+    for r in range(repeats - 1):
+        start = time.perf_counter_ns()
+        for i in range(n):
+            op()
+        best = min(best, time.perf_counter_ns() - start)
+    return best / n
+
+
+def measure_memory(op):
+    """(peak, retained) bytes allocated by one call of op"""
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        op()
+        (current, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return (peak - base, max(current - base, 0))
+
+
+def consume(lines):
+    for line in lines:
+        pass
+
+
+def cases(main, pump, snapshot, history, workdir):
+    """Generate (name, function to time, directory to run it in or None)"""
+    for command in COMMANDS:
+        yield ("cmd/" + command.split()[0], lambda command=command: main.process_command(command, NullWriter()), None)
+
+    systems = dict()
+    for n in DOMAIN_COUNTS:
+        config = bench_config(n)
+        ws = pump.WateringSystem()
+        ws.get_config(config)
+        ws.configfile = "config.json"
+        systems[n] = ws
+        yield ("get_config/{}".format(n), lambda ws=ws, config=config: ws.get_config(config), None)
+
+    for n in DOMAIN_COUNTS:
+        ws = systems[n]
+        dt = quiet_time(ws)
+        yield ("check_schedule/{}".format(n), lambda ws=ws, dt=dt: ws.check_schedule(dt), None)
+
+    for n in DOMAIN_COUNTS:
+        ws = systems[n]
+        # Rendered a line at a time, as the sessions write it out
+        yield ("info_lines/{}".format(n), lambda ws=ws: consume(ws.info_lines()), None)
+        yield ("config_lines/{}".format(n), lambda ws=ws: consume(ws.config_lines()), None)
+
+    for n in DOMAIN_COUNTS:
+        ws = systems[n]
+        filename = "snapshot{}.bin".format(n)
+        snapshot.save(filename, 0, ws.name, ws.settings, ws.domains.values())
+        yield ("snapshot_load/{}".format(n), lambda filename=filename: snapshot.load(filename, 0, pump.Domain), None)
+
+    for n in HISTORY_SIZES:
+        h = history.History("history{}.bin".format(n), n)
+        for i in range(n):
+            h.append("domain{}".format(i % 20), 10, 0, i)
+        yield ("history_append/{}".format(n), lambda h=h: h.append("domain0", 12.5, 1), None)
+
+    for n in DIRECTORY_SIZES:
+        directory = os.path.join(workdir, "dir{}".format(n))
+        os.mkdir(directory)
+        for i in range(n):
+            open(os.path.join(directory, "file{}".format(i)), "w").close()
+        # The worst case, a file that isn't there
+        yield ("exists/{}".format(n), lambda: pump.exists("config.json"), directory)
+
+
+async def run_cases(main, pump, snapshot, history, workdir, pattern):
+    """Measure the cases whose name contains pattern, return {name: result} and the calibration"""
+    selected = [c for c in cases(main, pump, snapshot, history, workdir) if not pattern or pattern in c[0]]
+    results = dict()
+    calibration = None
+    for i in range(ROUNDS):
+        ns = calibrate()
+        calibration = ns if calibration is None else min(calibration, ns)
+        for (name, op, directory) in selected:
+            if directory:
+                os.chdir(directory)
+            try:
+                ns = measure_time(op)
+                if name not in results:
+                    (peak, retained) = measure_memory(op)
+                    results[name] = {"ns": ns, "peak": peak, "retained": retained}
+            finally:
+                os.chdir(workdir)
+            results[name]["ns"] = min(results[name]["ns"], ns)
+            # Let the tasks started by the commands (e.g. a cancelled watering) finish
+            await asyncio.sleep(0)
+    for r in results.values():
+        r["ns"] = round(r["ns"])
+    return (results, calibration)
+
+
+def run(pattern=None):
+    """Run the benchmarks in a scratch directory, return the results"""
+    workdir = tempfile.mkdtemp(prefix="watering-bench-")
+    cwd = os.getcwd()
+    console = io.StringIO()
+    try:
+        shutil.copy(os.path.join(hal.PICO_DIR, "banner.txt"), workdir)
+        with open(os.path.join(workdir, "config.json"), "w") as f:
+            json.dump(bench_config(COMMAND_DOMAINS), f)
+        os.chdir(workdir)
+        hal.reset()
+        hal.set_localtime(2024, 4, 2, 3, 0)
+        with contextlib.redirect_stdout(console):
+            main = hal.load("main")
+            pump = hal.load("pump")
+            snapshot = hal.load("snapshot")
+            history = hal.load("history")
+            main.boot()
+            # Only errors are of interest here, and the log lines would be part of the timings
+            main.logs.console = main.logs.level = 100
+            loop = hal.new_loop()
+            (results, calibration) = loop.run_until_complete(run_cases(main, pump, snapshot, history, workdir, pattern))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+    return {"calibration_ns": round(calibration), "python": sys.version.split()[0], "results": results}
+
+
+def time_ratios(run, baseline):
+    """{name: time relative to the baseline} of the cases in both, and their median (1 if
+       too few of the baseline cases ran)"""
+    scale = baseline["calibration_ns"] / run["calibration_ns"]
+    ratios = dict((name, r["ns"] * scale / baseline["results"][name]["ns"])
+                  for (name, r) in run["results"].items() if name in baseline["results"])
+    if not ratios or len(ratios) < len(baseline["results"]) * MEDIAN_SHARE:
+        return (ratios, 1)
+    values = sorted(ratios.values())
+    return (ratios, values[len(values) // 2])
+
+
+def compare(run, baseline, threshold, mem_threshold, floor=5, again=None):
+    """Rows of the result table, the median time ratio, the list of regressions against a
+       baseline and the names of the cases that got slower. A case is only slower if it
+       takes threshold times as long as the median and more than floor us longer, as the
+       cases of a few us vary by more than the threshold from run to run, and the median
+       itself is slower (named "median") if it is above threshold. With the results of a
+       second run, a case or the median is only slower if it is in both."""
+    rows = []
+    regressions = []
+    slower = []
+    (ratios, median) = time_ratios(run, baseline) if baseline else (dict(), 1)
+    (ratios2, median2) = time_ratios(again, baseline) if again else (dict(), 1)
+    for (name, r) in run["results"].items():
+        base = baseline["results"].get(name) if baseline else None
+        row = [name, "{:.1f}".format(r["ns"] / 1000), str(r["peak"]), str(r["retained"]), "", ""]
+        if base:
+            ratio = ratios[name] / median
+            if name in ratios2:
+                ratio = min(ratio, ratios2[name] / median2)
+            row[4] = "{:.2f}".format(ratio)
+            row[5] = "{:.2f}".format(r["peak"] / base["peak"]) if base["peak"] else "-"
+            if ratio > threshold and (ratio - 1) * base["ns"] > floor * 1000:
+                regressions.append("{} takes {:.2f} times as long as the baseline".format(name, ratio))
+                slower.append(name)
+            # Allow for a few small objects that come and go with CPython's caches
+            if r["peak"] > base["peak"] * mem_threshold + 512:
+                regressions.append("{} allocates {} bytes, {} in the baseline".format(name, r["peak"], base["peak"]))
+        rows.append(row)
+    if again and ratios2:
+        median = min(median, median2)
+    if median > threshold:
+        regressions.insert(0, "The cases take {:.2f} times as long as the baseline (median)".format(median))
+        slower.insert(0, "median")
+    return (rows, median, regressions, slower)
+
+
+def format_table(headers, rows):
+    widths = [max(len(str(r[i])) for r in [headers] + rows) for i in range(len(headers))]
+    lines = ["  ".join(str(v).rjust(w) if i else str(v).ljust(w) for (i, (v, w)) in enumerate(zip(r, widths))).rstrip()
+             for r in [headers] + rows]
+    lines.insert(1, "  ".join("-" * w for w in widths))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--filter", help="only run the cases whose name contains this")
+    parser.add_argument("--save", metavar="FILE", help="write the results as a baseline file")
+    parser.add_argument("--check", metavar="FILE", help="compare with a baseline file and fail on regressions")
+    parser.add_argument("--threshold", type=float, default=1.5, help="allowed slowdown against the baseline")
+    parser.add_argument("--floor", type=float, default=5, help="slowdowns of fewer microseconds are ignored")
+    parser.add_argument("--mem-threshold", type=float, default=1.25, help="allowed growth of the peak allocation")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    results = run(args.filter)
+    baseline = None
+    if args.check:
+        with open(args.check) as f:
+            baseline = json.load(f)
+    (rows, median, regressions, slower) = compare(results, baseline, args.threshold, args.mem_threshold, args.floor)
+    if slower:
+        again = run(args.filter)
+        (rows, median, regressions, slower) = compare(results, baseline, args.threshold, args.mem_threshold, args.floor, again)
+    if args.json:
+        print(json.dumps(results, indent=1))
+    else:
+        print(format_table(["case", "us/call", "peak B", "kept B", "time x", "peak x"], rows))
+        print("Calibration: {:.1f} us".format(results["calibration_ns"] / 1000))
+        if baseline:
+            print("Median time against the baseline: {:.2f}".format(median))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+            f.write("\n")
+    for r in regressions:
+        print(r)
+    if regressions:
+        print("{} regressions found".format(len(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,212 @@
+import time
+import json
+from metrics import metrics
+
+def is_stream(value):
+    """Is value a generator to be written out an item at a time (see response_lines)"""
+    return not (value is None or isinstance(value, (str, int, float, bool, list, tuple, dict)))
+
+def has_stream(value):
+    return isinstance(value, dict) and any(is_stream(v) or has_stream(v) for v in value.values())
+
+def value_lines(value, closers, prefix):
+    """Generate the json text of value after prefix, streaming the generators in it. The
+       brackets left open are kept in closers, so a failure can close them."""
+    if is_stream(value):
+        closers.append("]")
+        yield prefix + "["
+        sep = ""
+        for item in value:
+            yield sep + json.dumps(item)
+            sep = ", "
+        closers.pop()
+        yield "]"
+    elif has_stream(value):
+        closers.append("}")
+        yield prefix + "{"
+        sep = ""
+        for (k, v) in value.items():
+            for s in value_lines(v, closers, sep + json.dumps(k) + ": "):
+                yield s
+            sep = ", "
+        closers.pop()
+        yield "}"
+    else:
+        yield prefix + json.dumps(value)
+
+def response_lines(resp, prefix=""):
+    """Generate the json text of a response a piece at a time, with the generators in it
+       (e.g. the domains of info) written out an item at a time so that a large response
+       is neither held in RAM nor truncated. If a generator fails, the open lists and
+       objects are closed and the response ends with "ok": false and the error, so the
+       text stays valid json."""
+    closers = []
+    yield prefix + "{"
+    sep = ""
+    # The plain values (e.g. the id) go first, so they are there even if a stream fails
+    keys = [k for (k, v) in resp.items() if k != "ok" and not (is_stream(v) or has_stream(v))]
+    keys += [k for k in resp if k != "ok" and k not in keys]
+    try:
+        for k in keys:
+            for s in value_lines(resp[k], closers, sep + json.dumps(k) + ": "):
+                yield s
+                sep = ", "
+    except (KeyError, TypeError, ValueError, IndexError):
+        yield "".join(reversed(closers)) + sep + "\"ok\": false, \"error\": \"invalid arguments\"}"
+        return
+    except Exception as e:
+        yield "".join(reversed(closers)) + sep + "\"ok\": false, \"error\": " + json.dumps("failed: {!r}".format(e)) + "}"
+        return
+    yield sep + "\"ok\": " + json.dumps(resp.get("ok", False)) + "}"
+
+def batch_lines(resps):
+    prefix = "["
+    for resp in resps:
+        for s in response_lines(resp, prefix):
+            yield s
+        prefix = ", "
+    yield "]" if prefix == ", " else "[]"
+
+class Api:
+    """Machine readable protocol for automation: one json request per line answered
+       with one json response per line.
+
+       A request is an object with a "cmd" and its arguments, e.g. {"cmd": "water",
+       "domains": ["herbs", "bonsai"], "duration": 10}, or a list of requests answered
+       with a list of responses in the same line. An "id" in a request is copied to its
+       response. Every response has "ok" and, if it is false, an "error".
+
+       Lists that grow with the number of domains or records are returned by the handlers
+       as generators and streamed, see response_lines."""
+    def __init__(self, ws, scheduler, set_time):
+        self.ws = ws
+        self.scheduler = scheduler
+        self.set_time = set_time
+
+    def handle(self, line):
+        """Run the requests of a request line and return a generator of the text of the
+           response line"""
+        try:
+            req = json.loads(line)
+        except ValueError:
+            return iter((json.dumps({"ok": False, "error": "invalid json"}) + "\n",))
+        if isinstance(req, list):
+            lines = batch_lines([self.request(r) for r in req])
+        else:
+            lines = response_lines(self.request(req))
+        return self.end_line(lines)
+
+    def end_line(self, lines):
+        for s in lines:
+            yield s
+        yield "\n"
+
+    def request(self, req):
+        if not isinstance(req, dict) or "cmd" not in req:
+            return {"ok": False, "error": "request must be an object with a cmd"}
+        handler = getattr(self, "api_" + str(req["cmd"]), None)
+        if handler is None:
+            resp = {"ok": False, "error": "unknown cmd"}
+        else:
+            try:
+                resp = handler(req)
+            except (KeyError, TypeError, ValueError, IndexError):
+                resp = {"ok": False, "error": "invalid arguments"}
+            except Exception as e:
+                resp = {"ok": False, "error": "failed: {!r}".format(e)}
+        if "id" in req:
+            resp["id"] = req["id"]
+        return resp
+
+    def domain_names(self, req):
+        """Domain names of a request with either "domain" or a list of "domains\""""
+        if "domains" in req:
+            return req["domains"]
+        return [req["domain"]]
+
+    def api_info(self, req):
+        # The domains can change while the response is written out
+        return {"ok": True, "name": self.ws.name, "time": list(time.localtime()),
+                "domains": (d.state() for d in tuple(self.ws.domains.values()))}
+
+    def api_domain(self, req):
+        d = self.ws.domains.get(req["domain"])
+        if d is None:
+            return {"ok": False, "error": "no such domain"}
+        return {"ok": True, "domain": d.state()}
+
+    def api_water(self, req):
+        duration = req.get("duration")
+        if duration is not None and ((duration <= 0) or (duration > 60)):
+            return {"ok": False, "error": "duration must be between 0 and 60 seconds"}
+        results = []
+        for name in self.domain_names(req):
+            d = self.ws.domains.get(name)
+            if d is None:
+                results.append({"domain": name, "ok": False, "error": "no such domain"})
+            elif d.is_running():
+                results.append({"domain": name, "ok": False, "error": "already watering"})
+            elif not d.start_watering(duration):
+                results.append({"domain": name, "ok": False, "error": "already queued"})
+            else:
+                results.append({"domain": name, "ok": True, "queued": not d.is_running()})
+        return {"ok": all([r["ok"] for r in results]), "results": results}
+
+    def api_stop(self, req):
+        if req.get("domain") == "all":
+            names = list(self.ws.domains.keys())
+        else:
+            names = self.domain_names(req)
+        stopped = [name for name in names if name in self.ws.domains and self.ws.domains[name].stop()]
+        return {"ok": True, "stopped": stopped}
+
+    def api_history(self, req):
+        entries = self.ws.history_entries(req.get("domain"), req.get("n", 10))
+        return {"ok": True, "history": ({"time": list(t[:6]), "domain": name, "duration": duration, "source": source}
+                                        for (t, name, duration, source) in entries)}
+
+    def api_report(self, req):
+        totals = self.ws.usage_totals(req.get("domain"), req.get("days", 7))
+        return {"ok": True, "report": ({"domain": name, "runs": runs, "seconds": seconds, "liters": liters}
+                                       for (name, runs, seconds, liters) in totals)}
+
+    def api_time(self, req):
+        return {"ok": True, "time": list(time.localtime())}
+
+    def api_set_time(self, req):
+        (year, month, mday, hour, minute) = req["time"][:5]
+        self.set_time(year, month, mday, hour, minute)
+        return {"ok": True, "time": list(time.localtime())}
+
+    def api_config(self, req):
+        if not self.ws.configfile:
+            return {"ok": True, "config": None}
+        config_data = {"name": self.ws.name, "domains": (d.config() for d in tuple(self.ws.domains.values()))}
+        config_data.update(self.ws.settings)
+        return {"ok": True, "config": config_data}
+
+    def api_update_config(self, req):
+        if not self.ws.apply_config(req["config"]):
+            return {"ok": False, "error": "invalid configuration"}
+        self.scheduler.rebuild()
+        return {"ok": True}
+
+    def api_patch_config(self, req):
+        n = self.ws.apply_patch(req["patch"])
+        if n is None:
+            return {"ok": False, "error": "invalid patch"}
+        self.scheduler.rebuild()
+        return {"ok": True, "changed": n}
+
+    def api_queue(self, req):
+        queue = self.ws.queue
+        return {"ok": True, "running": [j.domain.name for j in queue.running],
+                "pending": [j.domain.name for j in sorted(queue.pending, key=lambda j: (j.source, j.seq))]}
+
+    def api_stats(self, req):
+        return {"ok": True, "stats": metrics.values()}
+
+    def api_storage(self, req):
+        store = self.ws.store
+        return {"ok": True, "bytes_written": store.bytes_written, "bytes_per_hour": store.bytes_per_hour(),
+                "journal_size": store.journal_size, "unsaved": len(store.dirty)}
@@ -0,0 +1,90 @@
+import time
+from metrics import metrics
+from log import get_logger
+
+log = get_logger("commands")
+
+class Dispatcher:
+    """Map the first word of a command to a registered handler.
+
+       Handlers are called as handler(args, writer) with the rest of the command
+       after the first word, and return 1 to close the session.  A line can hold
+       several commands separated by ";", except after a raw command which takes
+       the rest of the line as its arguments (e.g. a json string).  The run time of
+       each command is kept in a cmd_ms.<name> histogram. A handler that raises an
+       exception answers "Invalid command" and is counted in cmd_errors, so one bad
+       argument can't take down the session that sent it."""
+    def __init__(self):
+        self.handlers = dict()
+        self.usage = []
+        self.latency = dict()
+        self.errors = metrics.counter("cmd_errors")
+
+    def register(self, name, handler, usage=None, help=None, raw=False):
+        self.handlers[name] = (handler, raw)
+        if help:
+            self.usage.append((usage or name, help))
+
+    def command(self, name, usage=None, help=None, raw=False):
+        """Decorator registering a handler"""
+        def decorator(handler):
+            self.register(name, handler, usage, help, raw)
+            return handler
+        return decorator
+
+    def dispatch(self, line, writer):
+        """Run the commands of a line in order, return 1 if one of them closes the session"""
+        for (name, args) in self.split(line):
+            if self.run(name, args, writer):
+                return 1
+        return 0
+
+    def split(self, line):
+        """Generate the (name, args) of the commands of a line"""
+        line = line.strip()
+        while line:
+            # The command name ends at the first space or ;
+            end = len(line)
+            for sep in " ;":
+                i = line.find(sep)
+                if i >= 0 and i < end:
+                    end = i
+            name = line[:end]
+            entry = self.handlers.get(name)
+            if entry and entry[1]:
+                args = line[end:].strip()
+                line = ""
+            else:
+                i = line.find(";", end)
+                if i < 0:
+                    i = len(line)
+                args = line[end:i].strip()
+                line = line[i + 1:].strip()
+
+            if name:
+                yield (name, args)
+
+    def run(self, name, args, writer):
+        """Run one command, return 1 if it closes the session"""
+        entry = self.handlers.get(name)
+        if entry is None:
+            writer.write("Invalid command, try again\n")
+            return 0
+        start = time.ticks_ms()
+        try:
+            ret = entry[0](args, writer)
+        except Exception as e:
+            self.errors.inc()
+            log.error("Command {} {} failed: {!r}", name, args, e)
+            writer.write("Invalid command: {}\n".format(e))
+            ret = 0
+        if name not in self.latency:
+            self.latency[name] = metrics.histogram("cmd_ms." + name)
+        self.latency[name].observe(time.ticks_diff(time.ticks_ms(), start))
+        return 1 if ret else 0
+
+    def help_lines(self):
+        """Generate the list of valid commands"""
+        yield "The following commands are valid: \n"
+        for (usage, help) in self.usage:
+            yield "  {:<29}: {}\n".format(usage, help)
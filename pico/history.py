@@ -0,0 +1,129 @@
+import time
+import struct
+from store import atomic_rename
+from names import Names
+from log import get_logger
+
+log = get_logger("history")
+
+# File layout: a header followed by capacity fixed-width records used as a ring buffer.
+# Header: magic, capacity, index of the next record to write, number of records
+HEADER_FMT = "<4sIII"
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+MAGIC = b"WHS2"
+# Record: time.time() of the end of the watering, domain id (see names.py, so up to 65536
+# names), duration in tenths of a second, source
+RECORD_FMT = "<IHHBx"
+RECORD_SIZE = struct.calcsize(RECORD_FMT)
+
+SOURCE_MANUAL = 0
+SOURCE_SCHEDULED = 1
+source2name = ["manual", "scheduled"]
+
+class History:
+    """Watering history kept in a fixed size ring of binary records, so recording a
+       watering is one in-place record write and a header update. Domains are stored by
+       their id in names."""
+    def __init__(self, filename="history.bin", capacity=1000, names=None):
+        if not isinstance(capacity, int) or capacity < 1:
+            raise ValueError("history capacity must be a positive integer")
+        self.filename = filename
+        self.capacity = capacity
+        self.names = Names() if names is None else names
+        self.head = 0
+        self.count = 0
+        self.bytes_written = 0
+        self.buf = bytearray(max(HEADER_SIZE, RECORD_SIZE))
+        try:
+            with open(filename, "rb") as f:
+                n = f.readinto(self.buf)
+            (magic, cap, head, count) = struct.unpack_from(HEADER_FMT, self.buf)
+            if n >= HEADER_SIZE and magic == MAGIC and cap == capacity:
+                self.head = head
+                self.count = count
+                return
+            if n >= HEADER_SIZE and magic == MAGIC and cap > 0:
+                self.resize(cap, head, count)
+                return
+            log.warning("History file {} is not valid, starting a new history", filename)
+        except OSError:
+            pass
+        self.create()
+
+    def create(self, filename=None):
+        """Create an empty history file with space for capacity records"""
+        self.head = 0
+        self.count = 0
+        zeros = bytes(RECORD_SIZE * 64)
+        with open(filename or self.filename, "wb") as f:
+            f.write(self.pack_header())
+            remaining = self.capacity
+            while remaining > 0:
+                n = min(remaining, 64)
+                f.write(zeros[:n * RECORD_SIZE])
+                remaining -= n
+
+    def resize(self, old_capacity, old_head, old_count):
+        """Move the newest records of a history file of old_capacity records into a new
+           file of capacity records, a record at a time, and replace the old file with it"""
+        n = min(old_count, old_capacity, self.capacity)
+        log.warning("History file {} has {} records, keeping the newest {} of {} in {}",
+                    self.filename, old_capacity, n, old_count, self.capacity)
+        tmpname = self.filename + ".tmp"
+        self.create(tmpname)
+        buf = bytearray(RECORD_SIZE)
+        with open(self.filename, "rb") as old, open(tmpname, "r+b") as f:
+            # Copy the records newest first, to the slots before the new head
+            i = old_head
+            for k in range(n):
+                i = (i - 1) % old_capacity
+                old.seek(HEADER_SIZE + i * RECORD_SIZE)
+                old.readinto(buf)
+                f.seek(HEADER_SIZE + (n - 1 - k) * RECORD_SIZE)
+                f.write(buf)
+            self.head = n % self.capacity
+            self.count = n
+            f.seek(0)
+            f.write(self.pack_header())
+        self.bytes_written += HEADER_SIZE + self.capacity * RECORD_SIZE
+        atomic_rename(tmpname, self.filename)
+
+    def pack_header(self):
+        struct.pack_into(HEADER_FMT, self.buf, 0, MAGIC, self.capacity, self.head, self.count)
+        return memoryview(self.buf)[:HEADER_SIZE]
+
+    def append(self, name, duration, source, t=None):
+        """Record a watering of domain name lasting duration seconds"""
+        if t is None:
+            t = time.time()
+        did = self.names.id(name)
+        with open(self.filename, "r+b") as f:
+            struct.pack_into(RECORD_FMT, self.buf, 0, t, did, min(int(duration * 10), 0xffff), source)
+            f.seek(HEADER_SIZE + self.head * RECORD_SIZE)
+            f.write(memoryview(self.buf)[:RECORD_SIZE])
+            self.head = (self.head + 1) % self.capacity
+            if self.count < self.capacity:
+                self.count += 1
+            f.seek(0)
+            f.write(self.pack_header())
+        self.bytes_written += RECORD_SIZE + HEADER_SIZE
+
+    def records(self, name=None, n=10):
+        """Generate up to n (time, domain id, duration, source) records, newest first,
+           optionally only for domain name"""
+        did = None if name is None else self.names.get(name)
+        if name is not None and did is None:
+            return
+        buf = bytearray(RECORD_SIZE)
+        with open(self.filename, "rb") as f:
+            i = self.head
+            for k in range(self.count):
+                if n <= 0:
+                    break
+                i = (i - 1) % self.capacity
+                f.seek(HEADER_SIZE + i * RECORD_SIZE)
+                f.readinto(buf)
+                (t, rid, duration, source) = struct.unpack_from(RECORD_FMT, buf)
+                if did is None or rid == did:
+                    n -= 1
+                    yield (t, rid, duration / 10, source)
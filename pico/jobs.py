@@ -0,0 +1,113 @@
+import time
+from history import SOURCE_MANUAL, source2name
+
+class Job:
+    __slots__ = ("domain", "duration", "source", "seq", "start")
+
+    def __init__(self, domain, duration, source, seq):
+        self.domain = domain
+        self.duration = duration
+        self.source = source
+        self.seq = seq
+        self.start = None
+
+class JobQueue:
+    """Waterings waiting for a pump slot, so pumps sharing a supply don't all run at once.
+
+       At most max_running pumps run at the same time (None for no limit), and the sum of
+       the "current" of the running domains stays within current_budget (None for no limit),
+       except that a single job always runs. Manual jobs go before scheduled ones, otherwise
+       jobs run in the order they were submitted. A job for a domain that is already running
+       or queued is merged into it. Jobs are started when submitted or when a watering ends,
+       so there is no polling."""
+    def __init__(self, max_running=1, current_budget=None):
+        self.max_running = max_running
+        self.current_budget = current_budget
+        self.pending = []
+        self.running = []
+        self.seq = 0
+
+    def submit(self, domain, duration=None, source=SOURCE_MANUAL):
+        """Queue a watering of domain, return False if it was merged with a running or queued job"""
+        for job in self.running:
+            if job.domain is domain:
+                return False
+        for job in self.pending:
+            if job.domain is domain:
+                # A manual request takes over a queued scheduled one
+                if source < job.source:
+                    job.source = source
+                    job.duration = duration
+                return False
+        self.seq += 1
+        self.pending.append(Job(domain, duration, source, self.seq))
+        self.dispatch()
+        return True
+
+    def next_job(self):
+        best = None
+        for job in self.pending:
+            if best is None or (job.source, job.seq) < (best.source, best.seq):
+                best = job
+        return best
+
+    def fits(self, job):
+        if not self.running:
+            return True
+        if self.max_running is not None and len(self.running) >= self.max_running:
+            return False
+        if self.current_budget is not None:
+            current = job.domain.current
+            for j in self.running:
+                current += j.domain.current
+            if current > self.current_budget:
+                return False
+        return True
+
+    def dispatch(self):
+        """Start pending jobs in priority order while they fit the limits"""
+        while(True):
+            job = self.next_job()
+            if job is None or not self.fits(job):
+                return
+            self.pending.remove(job)
+            self.running.append(job)
+            job.start = time.time()
+            job.domain.start_task(job.duration, job.source)
+
+    def cancel(self, domain):
+        """Remove a queued job of domain, return True if there was one"""
+        for job in self.pending:
+            if job.domain is domain:
+                self.pending.remove(job)
+                return True
+        return False
+
+    def is_queued(self, domain):
+        for job in self.pending:
+            if job.domain is domain:
+                return True
+        return False
+
+    def finished(self, domain):
+        """Free the slot of a watering that ended (or was stopped) and start the next jobs"""
+        for job in self.running:
+            if job.domain is domain:
+                self.running.remove(job)
+                self.dispatch()
+                return
+
+    def lines(self):
+        """Generate a description of the running and pending jobs"""
+        yield "Limits: {} pumps, current budget {}\n".format(
+            "no limit of" if self.max_running is None else self.max_running,
+            "none" if self.current_budget is None else self.current_budget)
+        now = time.time()
+        yield "Running ({}):\n".format(len(self.running))
+        for job in self.running:
+            yield "  {} ({}, {} s, started {} s ago)\n".format(job.domain.name, source2name[job.source],
+                                                               job.duration or job.domain.duration, now - job.start)
+        pending = sorted(self.pending, key=lambda job: (job.source, job.seq))
+        yield "Pending ({}):\n".format(len(pending))
+        for (i, job) in enumerate(pending):
+            yield "  {}. {} ({}, {} s)\n".format(i + 1, job.domain.name, source2name[job.source], job.duration or job.domain.duration)
@@ -0,0 +1,116 @@
+import time
+import os
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+level2name = {DEBUG: "debug", INFO: "info", WARNING: "warning", ERROR: "error", OFF: "off"}
+name2level = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR, "off": OFF}
+
+class Log:
+    """Log lines kept in a ring buffer in RAM, optionally mirrored to the console and a file.
+
+       Each module logs through its own Logger, and a line is only formatted if its level is
+       enabled for that module (self.levels, or self.level for modules without a filter), so
+       disabled debug messages cost one dictionary lookup."""
+    def __init__(self, size=64):
+        self.level = INFO
+        self.levels = dict()
+        self.console = INFO
+        self.file = None
+        self.file_level = WARNING
+        self.file_size = 16384
+        self.resize(size)
+
+    def resize(self, size):
+        self.lines = [None] * size
+        self.head = 0
+        self.count = 0
+
+    def enabled(self, module, level):
+        return level >= self.levels.get(module, self.level)
+
+    def write(self, module, level, msg, args):
+        if args:
+            msg = msg.format(*args)
+        (year, month, mday, h, m, s, wday, yrday) = time.localtime()
+        line = "{:02}-{:02} {:02}:{:02}:{:02} {} {}: {}".format(month, mday, h, m, s, level2name[level][0].upper(), module, msg)
+        self.lines[self.head] = line
+        self.head = (self.head + 1) % len(self.lines)
+        if self.count < len(self.lines):
+            self.count += 1
+        if level >= self.console:
+            print(line)
+        if self.file and level >= self.file_level:
+            self.write_file(line)
+
+    def write_file(self, line):
+        """Append a line to the log file, moving a full file to <file>.1"""
+        try:
+            if os.stat(self.file)[6] > self.file_size:
+                os.rename(self.file, self.file + ".1")
+        except OSError:
+            pass
+        try:
+            with open(self.file, "a") as f:
+                f.write(line + "\n")
+        except OSError:
+            pass
+
+    def tail(self, n=None, module=None):
+        """Return the last n lines, oldest first, optionally only of one module"""
+        lines = []
+        for k in range(self.count):
+            if n is not None and len(lines) >= n:
+                break
+            line = self.lines[(self.head - 1 - k) % len(self.lines)]
+            if module is None or line.split(" ", 4)[3] == module + ":":
+                lines.append(line)
+        lines.reverse()
+        return lines
+
+    def configure(self, config):
+        """Apply log settings, e.g. {"level": "info", "modules": {"scheduler": "debug"},
+           "console": "off", "file": "log.txt", "file_level": "warning", "size": 64}.
+           Return 1 if a level name is not valid"""
+        try:
+            if "size" in config and config["size"] != len(self.lines):
+                self.resize(config["size"])
+            self.level = name2level[config.get("level", "info")]
+            self.levels = dict((m, name2level[l]) for (m, l) in config.get("modules", {}).items())
+            self.console = name2level[config.get("console", "info")]
+            self.file = config.get("file")
+            self.file_level = name2level[config.get("file_level", "warning")]
+        except KeyError:
+            return 1
+        return 0
+
+class Logger:
+    __slots__ = ("module",)
+
+    def __init__(self, module):
+        self.module = module
+
+    def log(self, level, msg, args):
+        if logs.enabled(self.module, level):
+            logs.write(self.module, level, msg, args)
+
+    def debug(self, msg, *args):
+        self.log(DEBUG, msg, args)
+
+    def info(self, msg, *args):
+        self.log(INFO, msg, args)
+
+    def warning(self, msg, *args):
+        self.log(WARNING, msg, args)
+
+    def error(self, msg, *args):
+        self.log(ERROR, msg, args)
+
+# Log shared by all modules
+logs = Log()
+
+def get_logger(module):
+    return Logger(module)
@@ -5,37 +5,84 @@ try:
 except:
     pico_type = "PICO_H"
     
+import sys
 import time
 import re
 import uasyncio as asyncio
 from machine import UART, Pin, RTC
 
+# Milliseconds since reset when main.py started, the first boot phase
+boot_start = time.ticks_ms()
+
 from pump import *
+from scheduler import Scheduler
+from commands import Dispatcher
+from terminal import Terminal
+from session import Session, write_lines
+from api import Api
+from metrics import metrics
+from log import get_logger, logs, name2level
+
+log = get_logger("main")
 
 ver = "4.0"
 PORT = 31415
+API_PORT = 31416
+# Longest wait between attempts to join the Wi-Fi network, in seconds
+WIFI_MAX_BACKOFF = 300
+
+# Number of clients connected to the socket interface
+n_sessions = 0
+# Open sessions of all front ends (UART, USB and network clients)
+active_sessions = []
+
+# Metrics updated by the sessions and the Wi-Fi watchdog
+sessions = metrics.counter("sessions")
+reconnects = metrics.counter("wifi_reconnects")
+wifi_failures = metrics.counter("wifi_failures")
+api_latency = metrics.histogram("api_ms")
+
+# Created by boot(), so importing main does no work
+ws = None
+scheduler = None
+rtc = None
+api = None
 
-# Set up watering system and RTC
-ws = WateringSystem("config.json")
-rtc = machine.RTC()
+# (phase, milliseconds since reset) of the boot phases done so far
+boot_times = [("import", boot_start)]
+
+def boot_phase(name):
+    boot_times.append((name, time.ticks_ms()))
+
+def boot():
+    """First boot stage: restore the clock and load the configuration, so that the
+       scheduler and local control can start right away. The network comes later."""
+    global ws, scheduler, rtc, api
+    rtc = RTC()
+    ws = WateringSystem("config.json")
+    boot_phase("config")
+    set_time_from_file()
+    boot_phase("clock")
+    scheduler = Scheduler(ws)
+    api = Api(ws, scheduler, set_time)
+    boot_phase("scheduler")
         
 def set_time_from_file():
-    # Set localtime based on set_localtime.txt file
-    if exists("localtime.txt"):
+    # Set localtime from the clock checkpoint in the runtime state (or the older localtime.txt file)
+    time_tuple = ws.store.get("clock")
+    if time_tuple is None and exists("localtime.txt"):
         tf = open("localtime.txt", "r")
         time_string = tf.read()
         time_tuple = [ int(s) for s in time_string.split(",") ]
-        rtc.datetime(time_tuple)
-        print("Set localtime from file: " + time_str())
         tf.close()
+    if time_tuple:
+        rtc.datetime(time_tuple)
+        log.info("Set localtime from file: {}", time_str())
         
 async def save_time_to_file():
     while(True):
-        # Save current localtime to file every 5 minutes or so
-        tf = open("localtime.txt", "w")
-        tf.write(", ".join([str(i) for i in rtc.datetime()]))
-        tf.close()
-        print("Saved localtime to file: " + time_str())
+        # Checkpoint the current localtime every 5 minutes or so, it is written with the next flush of the runtime state
+        ws.store.set("clock", list(rtc.datetime()))
         await asyncio.sleep(300)
         
 def time_str():
@@ -58,124 +105,344 @@ def print_banner(writer):
     #writer.write("\n\nWelcome to version {}!\nWatering System Name: {}\n\nEnter a command (type \"help\" for list of valid commands):\n".format(ver, ws_name))
     
     
-def process_command(command, writer):
-    print(command)
-    m_water = re.match(r"water ([a-zA-Z0-9_-]+)(\s([0-9.]+))*", command)
-    m_update_config = re.match(r"update_config ", command)
-    m_update_time = re.match(r"update_time ([0-9]+)/([0-9]+)/([0-9]+) ([0-9]+):([0-9]+)", command)
-    
-    if m_water:
-        domain_name = m_water.group(1)
-        if m_water.group(3):
-            duration = float(m_water.group(3))
-            if (duration <= 0) or (duration > 60):
-                writer.write("Error: watering duration must be between 0 and 60 seconds\n")
-            else:
-                status = ws.water_domain(domain_name, duration)
-                writer.write(status + "\n")
-        else:        
-            status = ws.water_domain(domain_name)
+# Argument patterns are compiled once rather than on every command
+water_args = re.compile(r"([a-zA-Z0-9_-]+)(\s+(\d+(\.\d+)?))?$")
+domain_args = re.compile(r"([a-zA-Z0-9_-]+)")
+time_args = re.compile(r"([0-9]+)/([0-9]+)/([0-9]+) ([0-9]+):([0-9]+)")
+
+commands = Dispatcher()
+
+@commands.command("water", "water <domain> [duration]", "water a domain")
+def cmd_water(args, writer):
+    m = water_args.match(args)
+    if not m:
+        writer.write("Invalid command, try again\n")
+    elif m.group(3):
+        duration = float(m.group(3))
+        if (duration <= 0) or (duration > 60):
+            writer.write("Error: watering duration must be between 0 and 60 seconds\n")
+        else:
+            status = ws.water_domain(m.group(1), duration)
             writer.write(status + "\n")
-    elif command == "info":
-        writer.write(ws.print_info())
-    elif command == "print_config":
-        writer.write(ws.print_config() + "\n")
-    elif m_update_config:
-        json_str = re.sub("update_config ", "", command).rstrip()
-        status = ws.update_config(json_str)
+    else:
+        status = ws.water_domain(m.group(1))
+        writer.write(status + "\n")
+
+@commands.command("stop", "stop <domain>|all", "stop watering a domain or all domains")
+def cmd_stop(args, writer):
+    m = domain_args.match(args)
+    if m:
+        status = ws.stop_domain(m.group(1))
         writer.write(status + "\n")
-    elif command == "print_time":
-        writer.write("Current Time: " + time_str() + "\n\n")
-    elif m_update_time:
-        month   = int(m_update_time.group(1))
-        mday    = int(m_update_time.group(2))
-        year    = int(m_update_time.group(3))
-        hour    = int(m_update_time.group(4))
-        minute  = int(m_update_time.group(5))
-        rtc.datetime((year, month, mday, 0, hour, minute, 0, 0))
-        writer.write("Time updated to: " + time_str() + "\n\n")
-    elif command == "help":
-        help_str = "The following commands are valid: \n"
-        help_str += "  water <domain> [duration]    : water a domain\n"
-        help_str += "  info                         : print info about watering system configuration\n"
-        help_str += "  print_config                 : print json configuration file\n"
-        help_str += "  update_config <json string>  : update json configuration file\n"
-        help_str += "  print_time                   : print the current local date and time\n"
-        help_str += "  update_time MM/DD/YYYY HH:MM : update the local date and time\n"
-        help_str += "  quit                         : close the connection\n"
-        help_str += "  help                         : list valid commands\n"
-        writer.write(help_str)
-    elif command == "quit":
-        return 1
     else:
         writer.write("Invalid command, try again\n")
+
+@commands.command("info", "info [domain]", "print info about watering system configuration or one domain")
+def cmd_info(args, writer):
+    write_lines(writer, ws.info_lines(args or None))
+
+@commands.command("print_config", "print_config", "print json configuration file")
+def cmd_print_config(args, writer):
+    write_lines(writer, ws.config_lines())
+    writer.write("\n")
+
+@commands.command("update_config", "update_config <json string>", "update json configuration file", raw=True)
+def cmd_update_config(args, writer):
+    status = ws.update_config(args)
+    scheduler.rebuild()
+    writer.write(status + "\n")
+
+@commands.command("patch_config", "patch_config <json patch>", "change part of the configuration, e.g. {\"domains\": {\"herbs\": {\"duration\": 10}}}", raw=True)
+def cmd_patch_config(args, writer):
+    status = ws.patch_config(args)
+    scheduler.rebuild()
+    writer.write(status + "\n")
+
+@commands.command("mem", "mem", "print free memory and memory used by the domains")
+def cmd_mem(args, writer):
+    write_lines(writer, ws.memory_lines())
+
+@commands.command("queue", "queue", "print the running and queued waterings")
+def cmd_queue(args, writer):
+    write_lines(writer, ws.queue.lines())
+
+@commands.command("history", "history [domain] [n]", "print the last n waterings (default 10)")
+def cmd_history(args, writer):
+    args = args.split()
+    n = 10
+    if args and args[-1].isdigit():
+        n = int(args.pop())
+    name = args[0] if args else None
+    write_lines(writer, ws.history_lines(name, n))
+
+@commands.command("report", "report [domain] [days]", "print the waterings and water used over the last days (default 7)")
+def cmd_report(args, writer):
+    args = args.split()
+    days = 7
+    if args and args[-1].isdigit():
+        days = int(args.pop())
+    write_lines(writer, ws.usage_lines(args[0] if args else None, days))
+
+@commands.command("print_time", "print_time", "print the current local date and time")
+def cmd_print_time(args, writer):
+    writer.write("Current Time: " + time_str() + "\n\n")
+
+@commands.command("update_time", "update_time MM/DD/YYYY HH:MM", "update the local date and time")
+def cmd_update_time(args, writer):
+    m = time_args.match(args)
+    if not m:
+        writer.write("Invalid command, try again\n")
+        return
+    month   = int(m.group(1))
+    mday    = int(m.group(2))
+    year    = int(m.group(3))
+    hour    = int(m.group(4))
+    minute  = int(m.group(5))
+    set_time(year, month, mday, hour, minute)
+    writer.write("Time updated to: " + time_str() + "\n\n")
+
+@commands.command("api", "api", "switch the connection to the json lines protocol")
+def cmd_api(args, writer):
+    if isinstance(writer, Session):
+        writer.api = True
+        writer.write(json.dumps({"ok": True, "api": 1}) + "\n")
+    else:
+        writer.write("The json lines protocol is only available on the socket interface\n")
+
+@commands.command("storage", "storage [flush]", "print flash usage, or write unsaved state now")
+def cmd_storage(args, writer):
+    if args == "flush":
+        ws.store.flush()
+    writer.write(ws.storage_info())
+
+@commands.command("stats", "stats [dump]", "print metrics, or dump them as one json line")
+def cmd_stats(args, writer):
+    if args == "dump":
+        writer.write(metrics.dump() + "\n")
+        return
+    writer.write("Metrics (histograms show count, mean, max and count per bucket upper bound):\n")
+    write_lines(writer, metrics.lines())
+
+@commands.command("log", "log [n] [module]", "print the last n log lines, or set a level with log level <module|*> <level>")
+def cmd_log(args, writer):
+    args = args.split()
+    if args and args[0] == "level":
+        if len(args) != 3 or args[2] not in name2level:
+            writer.write("Usage: log level <module|*> <debug|info|warning|error|off>\n")
+        elif args[1] == "*":
+            logs.level = name2level[args[2]]
+        else:
+            logs.levels[args[1]] = name2level[args[2]]
+        return
+    n = None
+    if args and args[0].isdigit():
+        n = int(args.pop(0))
+    for line in logs.tail(n, args[0] if args else None):
+        writer.write(line + "\n")
+
+@commands.command("boot", "boot", "print how long each boot phase took")
+def cmd_boot(args, writer):
+    writer.write("Boot phases (ms since reset):\n")
+    last = 0
+    for (name, t) in boot_times:
+        writer.write("  {:<29}: {:>6} (+{})\n".format(name, t, time.ticks_diff(t, last)))
+        last = t
+
+@commands.command("sessions", "sessions", "list the open sessions")
+def cmd_sessions(args, writer):
+    writer.write("{} session(s):\n".format(len(active_sessions)))
+    for session in active_sessions:
+        writer.write("  {:<6} {:<5} {} commands, {} bytes out{}\n".format(session.name, "api" if session.api else "text",
+                     session.commands, session.bytes_out, " (this one)" if session is writer else ""))
+
+@commands.command("quit", "quit", "close the connection")
+def cmd_quit(args, writer):
+    return 1
+
+@commands.command("help", "help", "list valid commands")
+def cmd_help(args, writer):
+    write_lines(writer, commands.help_lines())
+
+def set_time(year, month, mday, hour, minute):
+    """Set the RTC and let the scheduler and runtime state know"""
+    rtc.datetime((year, month, mday, 0, hour, minute, 0, 0))
+    ws.store.set("clock", list(rtc.datetime()), urgent=True)
+    scheduler.clock_changed()
+
+def process_command(command, writer):
+    """Run the ;-separated commands in command, return 1 if the session should be closed"""
+    log.debug("Command: {}", command)
+    return commands.dispatch(command, writer)
+
+async def session_command(command, session):
+    """Run the ;-separated commands in command, writing out the output of each before
+       the next one runs, return 1 if the session should be closed"""
+    log.debug("Command: {}", command)
+    for (name, args) in commands.split(command):
+        stop = commands.run(name, args, session)
+        await session.flush()
+        if stop:
+            return 1
     return 0
 
-def connect_to_network(wlan, max_wait=10):
+async def connect_to_network(wlan, timeout=30):
+    """Join the network in wifi_config.json, waiting up to timeout seconds without
+       blocking the event loop, return True once connected"""
+    try:
+        with open("wifi_config.json", "r") as f:
+            data = json.load(f)
+            ssid = data["ssid"]
+            password = data["password"]
+    except (OSError, ValueError, KeyError):
+        log.error("wifi_config.json needs an ssid and a password")
+        return False
     wlan.active(True)
     wlan.config(pm = 0xa11140) # Disable power-save mode
-    with open("wifi_config.json", "r") as f:
-        data = json.load(f)
-        ssid = data["ssid"]
-        password = data["password"]
     wlan.connect(ssid, password)
 
-    while max_wait > 0:
+    start = time.ticks_ms()
+    while time.ticks_diff(time.ticks_ms(), start) < timeout * 1000:
         if wlan.status() < 0 or wlan.status() >= 3:
             break
-        max_wait -= 1
-        print('waiting for connection...')
-        time.sleep(1)
+        await asyncio.sleep_ms(250)
 
     if wlan.status() != 3:
-        #raise RuntimeError('network connection failed')
-        return None
-    else:
-        print('connected')
-        status = wlan.ifconfig()
-        print('ip = ' + status[0])
-        
-    return wlan
+        return False
+    log.info("connected, ip = {}", wlan.ifconfig()[0])
+    return True
+
+def socket_readline(reader):
+    """Line source of a network client: the next line as a string, or None once closed"""
+    async def readline():
+        line = await reader.readline()
+        if not line:
+            return None
+        return line.decode().rstrip()
+    return readline
 
-async def uart_term(uart):
-    print_banner(uart)
- 
-    while(True):
-        nchars = uart.any()
-        while nchars == 0:
-            await asyncio.sleep(.2)
-            nchars = uart.any()
-            
-        # Continue reading characters until a newline
-        command_line = ""
-        while ("\r" not in command_line) and ("\n" not in command_line):
-            rdata = uart.read()
-            if rdata:
-                command_line += rdata.decode()
-            await asyncio.sleep(.2)
-
-        if command_line:
-            command = command_line.rstrip()
-            uart.write(command + "\n")
-            process_command(command, uart)
-                
-            
 async def serve_client(reader, writer):
-    print("Client connected")
-    print_banner(writer)
+    """Human oriented command session"""
+    await serve_socket(reader, writer, False)
+    
+async def serve_api(reader, writer):
+    """Json lines session for automation, see api.py"""
+    await serve_socket(reader, writer, True)
     
-    # Command loop
+async def serve_socket(reader, writer, api_mode):
+    global n_sessions
+    # Limits can be changed with e.g. "server": {"max_sessions": 4, "idle_timeout": 600, "write_timeout": 10, "max_output": 32768}
+    server_config = ws.settings.get("server", {})
+    session = Session(writer, server_config.get("max_output", 32768), server_config.get("write_timeout", 10))
+    session.api = api_mode
+    if n_sessions >= server_config.get("max_sessions", 4):
+        log.warning("Client rejected, too many sessions")
+        session.notice("Too many sessions, try again later")
+        try:
+            await session.flush()
+        except (OSError, asyncio.TimeoutError):
+            pass
+        await session.close()
+        return
+
+    n_sessions += 1
+    sessions.inc()
+    log.info("Client connected")
+    try:
+        await run_session(session, socket_readline(reader), server_config.get("idle_timeout", 600))
+    finally:
+        n_sessions -= 1
+        await session.close()
+    log.info("Client disconnected")
+
+async def run_session(session, readline, idle_timeout=None):
+    """Command loop of a session of any front end, all sharing the one dispatcher.
+
+       readline() returns the next line or None when the client has gone. Each command
+       runs to completion and its output is flushed before the next line is read, and
+       flushing yields to the event loop, so sessions take turns a command at a time."""
+    active_sessions.append(session)
+    try:
+        if not session.api:
+            print_banner(session)
+            await session.flush()
+        
+        # Command loop
+        while(True):
+            try:
+                if idle_timeout:
+                    command = await asyncio.wait_for(readline(), idle_timeout)
+                else:
+                    command = await readline()
+            except asyncio.TimeoutError:
+                session.notice("Closing idle connection")
+                await session.flush()
+                break
+            except UnicodeError:
+                session.notice("Invalid command, try again")
+                await session.flush()
+                continue
+            if command is None:
+                # The client closed its end of the connection
+                break
+            if not command and not session.api:
+                continue
+            session.commands += 1
+            if session.api:
+                # Responses are streamed, as they can be larger than max_output
+                start = time.ticks_ms()
+                session.stream(api.handle(command))
+                await session.flush()
+                api_latency.observe(time.ticks_diff(time.ticks_ms(), start))
+                continue
+            stop = await session_command(command, session)
+            await session.flush()
+            if stop:
+                break
+    except (OSError, asyncio.TimeoutError):
+        log.warning("{} client not responding", session.name)
+    finally:
+        active_sessions.remove(session)
+
+async def serve_terminal(name, stream, out, echo, chunk=64):
+    """Serve a local terminal (UART or USB) for as long as the device runs. Its output
+       goes through a Session like a network client's, so a slow terminal only waits
+       for itself. After quit or a stalled output a new session starts."""
+    term = Terminal(stream, echo, out=out, chunk=chunk)
+    writer = asyncio.StreamWriter(out)
     while(True):
-        command_line = await reader.readline()
-        command = command_line.decode().rstrip()
-        stop = process_command(command, writer)
-        if stop:
-            break
+        session = Session(writer, 32768, 10, name)
+        try:
+            await run_session(session, term.readline)
+        except Exception as e:
+            # The terminal is the way in when all else fails, so it never stops
+            log.error("{} session failed: {!r}", name, e)
+        # Don't spin if the terminal can't take any output
+        await asyncio.sleep(1)
 
-    await writer.drain()
-    await writer.wait_closed()
-    print("Client disconnected")
-    
+def usb_streams():
+    """(input, output) streams of the USB serial port"""
+    return (sys.stdin.buffer, sys.stdout.buffer)
+
+def start_terminals():
+    """Start the sessions of the UART and USB terminals that are enabled. The UART is
+       left off if a domain uses its pins."""
+    # UART settings can be changed with e.g. "uart": {"enabled": true, "baudrate": 115200, "tx": 4, "rx": 5, "echo": true}
+    uart_config = ws.settings.get("uart", {})
+    (tx, rx) = (uart_config.get("tx", 4), uart_config.get("rx", 5))
+    if uart_config.get("enabled", True):
+        if [d for d in ws.domains.values() if d.gpio in (tx, rx)]:
+            log.error("The UART pins {} and {} are used by a domain, the UART terminal is off", tx, rx)
+        else:
+            log.info("Setting up uart...")
+            uart1 = UART(uart_config.get("id", 1), baudrate=uart_config.get("baudrate", 9600),
+                         tx=Pin(tx), rx=Pin(rx), rxbuf=256, txbuf=1024)
+            asyncio.create_task(serve_terminal("uart", uart1, uart1, uart_config.get("echo", True)))
+    # The USB serial port, "usb": {"enabled": false} leaves it to the REPL
+    usb_config = ws.settings.get("usb", {})
+    if usb_config.get("enabled", True):
+        (stdin, stdout) = usb_streams()
+        # A read of stdin only returns once the buffer is full, so read it a byte at a time
+        asyncio.create_task(serve_terminal("usb", stdin, stdout, usb_config.get("echo", True), chunk=1))
     
 async def blink_led():
     led = Pin(25, Pin.OUT)
@@ -185,69 +452,66 @@ async def blink_led():
         led_state = ~led_state
         await asyncio.sleep(2)
         
-async def check_watering_schedule():
-    while(True):
-        t = time.localtime()
-        print(t)
-        ws.check_schedule(t)
-        await asyncio.sleep(5)
-
 async def connect_to_wifi(wlan):
+    """Join the Wi-Fi network and rejoin it when the connection drops, waiting twice as
+       long after each failed attempt up to WIFI_MAX_BACKOFF seconds"""
+    delay = 1
+    connected = False
     while(True):
-        if wlan.status() != 3:
-            print('Re-connecting to network...')
-            ret = None
-            while ret == None:
-                ret = connect_to_network(wlan, 60)
-                await asyncio.sleep(1)
-        await asyncio.sleep(5)
+        if wlan.status() == 3:
+            await asyncio.sleep(5)
+            continue
+        if connected:
+            log.warning("Re-connecting to network...")
+            reconnects.inc()
+            connected = False
+        if await connect_to_network(wlan):
+            connected = True
+            delay = 1
+            if "wifi" not in [name for (name, t) in boot_times]:
+                boot_phase("wifi")
+        else:
+            wifi_failures.inc()
+            log.warning("Could not connect to network, retrying in {} s", delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WIFI_MAX_BACKOFF)
 
 async def main():
-    
-    #Set the localtime from file upon startup
-    set_time_from_file()
-        
-    #Launch the task that saves the current time to a file periodically
+    """Second boot stage: start the tasks, then local control and the network"""
+    #Launch the tasks that checkpoint the current time and write the runtime state to flash
     asyncio.create_task(save_time_to_file())
+    asyncio.create_task(ws.store.run())
+    
+    # Launch the task that sleeps until the next scheduled watering
+    asyncio.create_task(scheduler.run())
     
-    # Launch the task that checks the watering schedule every 5 seconds
-    asyncio.create_task(check_watering_schedule())
+    # Launch the task that samples the soil moisture sensors
+    asyncio.create_task(ws.sample_sensors())
     
-    # Set up UART terminal or socket interface for communication
+    # Launch the task that measures the event loop lag and free heap
+    asyncio.create_task(metrics.monitor())
+    boot_phase("tasks")
+    
+    # The local terminals run on both boards, alongside the network servers of the Pico W
+    start_terminals()
+    boot_phase("terminals")
     if pico_type == "PICO_W":
-        wlan = network.WLAN(network.STA_IF)
-        print('Connecting to Network...')
-        ret = None
-        while ret == None:
-            ret = connect_to_network(wlan, 60)
-            await asyncio.sleep(1)
-        asyncio.create_task(connect_to_wifi(wlan))
-        print('Setting up socket...')
-        loop = asyncio.get_event_loop()
-        loop.create_task(asyncio.start_server(serve_client, "0.0.0.0", PORT))
-        try: 
-            loop.run_forever()
-        except KeyboardInterrupt:
-            print("Closing socket")
-            loop.close()
-            
+        # The servers listen right away and answer once the network is up
+        log.info("Setting up socket...")
+        await asyncio.start_server(serve_client, "0.0.0.0", PORT)
+        await asyncio.start_server(serve_api, "0.0.0.0", API_PORT)
+        boot_phase("servers")
+        log.info("Connecting to Network...")
+        await connect_to_wifi(network.WLAN(network.STA_IF))
     else:
         #Blink the onboard LED to indicate the device is still alive
-        asyncio.create_task(blink_led())
-        print('Setting up uart...')
-        loop = asyncio.get_event_loop()
-        uart1 = UART(1, baudrate=9600, tx=Pin(4), rx=Pin(5))
-        loop.create_task(uart_term(uart1))
-        try: 
-            loop.run_forever()
-        except KeyboardInterrupt:
-            print("Closing UART connection")
-            loop.close()
+        await blink_led()
         
-try:
-    asyncio.run(main())
-finally:
-    asyncio.new_event_loop()
-
-
-        
\ No newline at end of file
+if __name__ == "__main__":
+    boot()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        log.info("Stopped")
+    finally:
+        asyncio.new_event_loop()
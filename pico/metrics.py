@@ -0,0 +1,128 @@
+import time
+import gc
+import json
+import uasyncio as asyncio
+from array import array
+
+# Bucket upper bounds for latencies in milliseconds and delays in seconds
+MS_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SECONDS_BUCKETS = (0, 1, 2, 5, 10, 30, 60, 300)
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dump(self):
+        return self.value
+
+    def text(self):
+        return str(self.value)
+
+class Gauge:
+    """Last value set and the lowest value seen"""
+    __slots__ = ("value", "min")
+
+    def __init__(self):
+        self.value = None
+        self.min = None
+
+    def set(self, value):
+        self.value = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def dump(self):
+        return [self.value, self.min]
+
+    def text(self):
+        return "{} (min {})".format(self.value, self.min)
+
+class Histogram:
+    """Number of observations in fixed buckets (the last one for values above all bounds),
+       with the count, sum and maximum, so an observation is a short scan and a few additions"""
+    __slots__ = ("bounds", "counts", "count", "sum", "max")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = array("I", [0] * (len(bounds) + 1))
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        i = 0
+        for b in self.bounds:
+            if value <= b:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def dump(self):
+        return {"le": list(self.bounds), "n": list(self.counts), "sum": self.sum, "max": self.max}
+
+    def text(self):
+        buckets = " ".join(["{}:{}".format(b, n) for (b, n) in zip(self.bounds, self.counts) if n])
+        if self.counts[-1]:
+            buckets += " inf:{}".format(self.counts[-1])
+        return "n={} mean={} max={} | {}".format(self.count, self.sum // self.count if self.count else 0, self.max, buckets)
+
+class Metrics:
+    """Registry of named counters, gauges and histograms. Metrics are created the first
+       time they are asked for, so callers keep the returned object and update it directly."""
+    def __init__(self):
+        self.metrics = dict()
+
+    def get(self, name, factory):
+        m = self.metrics.get(name)
+        if m is None:
+            m = factory()
+            self.metrics[name] = m
+        return m
+
+    def counter(self, name):
+        return self.get(name, Counter)
+
+    def gauge(self, name):
+        return self.get(name, Gauge)
+
+    def histogram(self, name, bounds=MS_BUCKETS):
+        return self.get(name, lambda: Histogram(bounds))
+
+    def lines(self):
+        """Generate the metrics as text lines sorted by name"""
+        for name in sorted(self.metrics):
+            yield "  {:<29}: {}\n".format(name, self.metrics[name].text())
+
+    def values(self):
+        """Return a dictionary of the values of all metrics"""
+        return dict((name, m.dump()) for (name, m) in self.metrics.items())
+
+    def dump(self):
+        """Return all metrics as one compact json line"""
+        return json.dumps(self.values(), separators=(",", ":"))
+
+    async def monitor(self, interval=1, heap_interval=60):
+        """Measure how late the event loop wakes a task (loop_lag_ms) and sample the free heap"""
+        lag = self.histogram("loop_lag_ms")
+        heap = self.gauge("heap_free")
+        heap_every = max(1, heap_interval // interval)
+        n = 0
+        while(True):
+            start = time.ticks_ms()
+            await asyncio.sleep(interval)
+            lag.observe(max(0, time.ticks_diff(time.ticks_ms(), start) - interval * 1000))
+            if n % heap_every == 0:
+                heap.set(gc.mem_free())
+            n += 1
+
+# Registry shared by all modules
+metrics = Metrics()
@@ -0,0 +1,57 @@
+import json
+from store import atomic_write
+from log import get_logger
+
+log = get_logger("names")
+
+class Names:
+    """Numbers of the domain names in the history and usage files, so that records tell
+       domains apart whatever their names.
+
+       A name is numbered the first time it is recorded, and appended to a file of one
+       json string per line whose line number is its id. Ids are never reused, so the
+       records of a removed domain stay with it if it is added again."""
+    def __init__(self, filename="names.txt"):
+        self.filename = filename
+        self.ids = dict()
+        self.names = []
+        self.bytes_written = 0
+        torn = False
+        try:
+            with open(filename, "r") as f:
+                for line in f:
+                    try:
+                        name = json.loads(line)
+                    except ValueError:
+                        # Incomplete line from a power cut while a name was added
+                        torn = True
+                        continue
+                    self.ids[name] = len(self.names)
+                    self.names.append(name)
+        except OSError:
+            pass
+        if torn:
+            log.warning("Names file {} has an incomplete line, rewriting it", filename)
+            self.bytes_written += atomic_write(filename, "".join(json.dumps(name) + "\n" for name in self.names))
+
+    def get(self, name):
+        """Return the id of a name, or None if it has none yet"""
+        return self.ids.get(name)
+
+    def id(self, name):
+        """Return the id of a name, numbering it if it is new"""
+        i = self.ids.get(name)
+        if i is not None:
+            return i
+        line = json.dumps(name) + "\n"
+        with open(self.filename, "a") as f:
+            f.write(line)
+        self.bytes_written += len(line)
+        i = len(self.names)
+        self.ids[name] = i
+        self.names.append(name)
+        return i
+
+    def name(self, i):
+        """Return the name of an id, or None if it is unknown"""
+        return self.names[i] if 0 <= i < len(self.names) else None
@@ -1,11 +1,36 @@
 from machine import Pin
 import time
+import uasyncio as asyncio
 import json
 import os
+import gc
+from schedule import Schedule, number2weekday, weekday2number, date_string, day_number
+from history import History, SOURCE_MANUAL, SOURCE_SCHEDULED, source2name
+from store import Store, atomic_write
+from metrics import metrics
+from sensor import make_sensor
+from jobs import JobQueue
+from usage import Usage, DAYS, WEEKS
+from names import Names
+import snapshot
+from log import get_logger, logs, name2level
+
+HISTORY_FILE = "history.bin"
+HISTORY_SIZE = 1000
+USAGE_FILE = "usage.bin"
+# Ids of the domain names in the history and usage files
+NAMES_FILE = "names.txt"
+# Patches applied with patch_config are appended here and replayed over config.json at boot,
+# until they are folded into config.json once the file grows past PATCH_COMPACT_SIZE bytes
+PATCH_FILE = "config.patch"
+PATCH_COMPACT_SIZE = 4096
+# Compiled configuration loaded at boot instead of config.json and config.patch while they
+# are unchanged, see snapshot.py
+SNAPSHOT_FILE = "config.bin"
+
+log = get_logger("pump")
 
 number2month = ["", "Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
-number2weekday = ["MON", "TUE", "WED", "THU", "FRI", "SAT", "SUN"]
-weekday2number = {"MON": 0, "TUE": 1, "WED": 2, "THU": 3, "FRI": 4, "SAT": 5, "SUN": 6}
 
 # Utility functions for filesystem
 def exists(filename):
@@ -24,26 +49,232 @@ def file_copy(infilename, outfilename):
     outfile.close()
     infile.close()
 
+def merge_patch(target, patch):
+    """Return target with a json merge patch (RFC 7396) applied, without modifying target"""
+    if not isinstance(patch, dict):
+        return patch
+    result = dict(target) if isinstance(target, dict) else dict()
+    for (k, v) in patch.items():
+        if v is None:
+            result.pop(k, None)
+        else:
+            result[k] = merge_patch(result.get(k), v)
+    return result
+
+def patch_config_data(config_data, patch):
+    """Return config_data with a configuration patch applied. The patch is a json merge patch,
+       except that "domains" is an object of merge patches keyed by domain name, with null
+       removing the domain, e.g. {"domains": {"herbs": {"duration": 10}, "bonsai": null}}"""
+    domain_patches = patch.get("domains", {})
+    if not isinstance(domain_patches, dict):
+        raise ValueError("domains must be an object")
+    result = merge_patch(config_data, dict((k, v) for (k, v) in patch.items() if k != "domains"))
+    domains = []
+    for d in config_data["domains"]:
+        if d["name"] not in domain_patches:
+            domains.append(d)
+        elif domain_patches[d["name"]] is not None:
+            domains.append(merge_patch(d, domain_patches[d["name"]]))
+            domains[-1]["name"] = d["name"]
+    names = [d["name"] for d in config_data["domains"]]
+    for (name, p) in domain_patches.items():
+        if name not in names and p is not None:
+            domains.append(merge_patch(None, p))
+            domains[-1]["name"] = name
+    result["domains"] = domains
+    return result
+
+def compile_domain(d):
+    """Check a domain dictionary from the configuration and compile its schedule,
+       return (schedule or None, missed policy, soil sensor or None, current, flow) or None if it is invalid"""
+    if not isinstance(d.get("name"), str) or not isinstance(d.get("gpio"), int) or not isinstance(d.get("duration"), (int, float)):
+        return None
+    # Policy for slots skipped over when the clock jumps forward
+    missed = d.get("missed", "skip")
+    if missed not in ("run", "skip"):
+        log.error("missed must be \"run\" or \"skip\"")
+        return None
+    schd = None
+    # Check if there is a schedule associated with the domain
+    if "schedule" in d:
+        schd = compile_schedule(d["schedule"], d.get("every_days"), d.get("start_date"), d.get("season"))
+        if schd is None:
+            return None
+        if not schd.count:
+            schd = None
+    # Optional soil moisture sensor that can skip or shorten scheduled waterings
+    sensor = None
+    if "sensor" in d:
+        sensor = make_sensor(d["sensor"])
+        if sensor is None:
+            log.error("sensor needs a gpio, different dry and wet readings and shorten_above below skip_above")
+            return None
+    # Pump current, counted against the current_budget of the job queue
+    current = d.get("current", 0)
+    if not isinstance(current, (int, float)) or current < 0:
+        log.error("current must be a number of mA")
+        return None
+    # Flow rate of the pump in liters per minute, for the water volume in usage reports
+    flow = d.get("flow", 0)
+    if not isinstance(flow, (int, float)) or flow < 0:
+        log.error("flow must be a number of liters per minute")
+        return None
+    return (schd, missed, sensor, current, flow)
+
+# Keys allowed in the persist and log settings, see Store.set_policy and Log.configure
+PERSIST_KEYS = ("flush_interval", "flush_dirty", "compact_size")
+LOG_KEYS = ("level", "modules", "console", "file", "file_level", "size")
+# Settings of the network sessions and the terminals: (key, smallest value or None for a boolean)
+SERVER_KEYS = (("max_sessions", 1), ("idle_timeout", 0), ("write_timeout", 1), ("max_output", 1))
+UART_KEYS = (("enabled", None), ("echo", None), ("id", 0), ("baudrate", 1), ("tx", 0), ("rx", 0))
+USB_KEYS = (("enabled", None), ("echo", None))
+
+def is_int(v):
+    return isinstance(v, int) and not isinstance(v, bool)
+
+def check_section(config_data, section, keys):
+    """Check a dictionary of settings with the given (key, smallest value or None for a
+       boolean) keys, return 1 if it is not valid"""
+    values = config_data.get(section, {})
+    names = [k for (k, low) in keys]
+    if not isinstance(values, dict) or [k for k in values if k not in names]:
+        log.error("{} may only have {}", section, ", ".join(names))
+        return 1
+    for (k, low) in keys:
+        if k not in values:
+            continue
+        v = values[k]
+        if low is None:
+            if not isinstance(v, bool):
+                log.error("{} {} must be true or false", section, k)
+                return 1
+        elif not is_int(v) or v < low:
+            log.error("{} {} must be an integer of at least {}", section, k, low)
+            return 1
+    return 0
+
+def check_settings(config_data):
+    """Check the top level settings that apply_settings uses, return 1 if one is not valid"""
+    history_size = config_data.get("history_size", HISTORY_SIZE)
+    if not is_int(history_size) or history_size < 1:
+        log.error("history_size must be a positive integer")
+        return 1
+    pumps = config_data.get("pumps", {})
+    if not isinstance(pumps, dict) or [k for k in pumps if k not in ("max_running", "current_budget")]:
+        log.error("pumps may only have a max_running and a current_budget")
+        return 1
+    for (k, v) in pumps.items():
+        if v is not None and (not is_int(v) or v < (1 if k == "max_running" else 0)):
+            log.error("pumps {} must be a positive integer or null", k)
+            return 1
+    persist = config_data.get("persist", {})
+    if not isinstance(persist, dict) or [k for k in persist if k not in PERSIST_KEYS]:
+        log.error("persist may only have {}", ", ".join(PERSIST_KEYS))
+        return 1
+    for v in persist.values():
+        if not isinstance(v, (int, float)) or isinstance(v, bool) or v < 0:
+            log.error("persist settings must be positive numbers")
+            return 1
+    log_config = config_data.get("log", {})
+    if not isinstance(log_config, dict) or [k for k in log_config if k not in LOG_KEYS]:
+        log.error("log may only have {}", ", ".join(LOG_KEYS))
+        return 1
+    modules = log_config.get("modules", {})
+    levels = [log_config[k] for k in ("level", "console", "file_level") if k in log_config]
+    if not isinstance(modules, dict) or [l for l in levels + list(modules.values()) if l not in name2level]:
+        log.error("log levels must be one of {}", ", ".join(name2level))
+        return 1
+    if "size" in log_config and (not is_int(log_config["size"]) or log_config["size"] < 1):
+        log.error("log size must be a positive integer")
+        return 1
+    if log_config.get("file") is not None and not isinstance(log_config["file"], str):
+        log.error("log file must be a file name")
+        return 1
+    if check_section(config_data, "server", SERVER_KEYS) > 0 or check_section(config_data, "uart", UART_KEYS) > 0 \
+            or check_section(config_data, "usb", USB_KEYS) > 0:
+        return 1
+    sensor_interval = config_data.get("sensor_interval", 10)
+    if not isinstance(sensor_interval, (int, float)) or isinstance(sensor_interval, bool) or sensor_interval <= 0:
+        log.error("sensor_interval must be a positive number of seconds")
+        return 1
+    return 0
+
+def compile_schedule(schd, every_days=None, start_date=None, season=None):
+    """Compile the schedule entries of a domain, return the Schedule or None if invalid"""
+    domain_schd = Schedule()
+    for entry in schd:
+        if domain_schd.add_entry(entry) > 0:
+            return None
+    if every_days is not None:
+        if domain_schd.set_every_days(every_days, start_date) > 0:
+            return None
+    if season is not None:
+        if domain_schd.set_season(season) > 0:
+            return None
+    return domain_schd
+
 class WateringSystem:
     def __init__(self, configfile=None):
         self.name = ""
+        self.domains = dict()
+        self.settings = dict()
+        self.history = None
+        self.store = Store()
+        self.queue = JobQueue()
+        self.names = Names(NAMES_FILE)
+        self.usage = Usage(USAGE_FILE, self.names)
+        self.store.hooks.append(self.usage.checkpoint)
+        # Heap used per domain, measured when the configuration is loaded
+        self.domain_size = 0
         if configfile is not None and exists(configfile):
             self.read_configfile(configfile)
         else:
-            print("Watering system initialized without a configuration file.")
+            log.info("Watering system initialized without a configuration file")
             self.configfile = None
         
 
     def read_configfile(self, configfile):
-        print("Loading configuration file {}...".format(configfile))
+        if self.load_snapshot(configfile):
+            log.info("Loaded configuration snapshot of {}", configfile)
+            self.configfile = configfile
+            return
+        log.info("Loading configuration file {}...", configfile)
         with open(configfile, "r") as f:
-            self.config_data = self.get_config(json.load(f))
-            if self.config_data:
-                print("Succesfully loaded configuration file")
+            # Only the objects built from the configuration are kept, see config()
+            if self.get_config(self.replay_patches(json.load(f))):
+                log.info("Succesfully loaded configuration file")
                 self.configfile = configfile
+                self.save_snapshot()
             else:
                 self.configfile = None
-                print("Error loading configuration file.")
+                log.error("Error loading configuration file {}", configfile)
+
+    def load_snapshot(self, configfile):
+        """Load the configuration from the snapshot if it was made from the current
+           configuration and patch files, return True if succesful"""
+        crc = snapshot.source_crc((configfile, PATCH_FILE))
+        gc.collect()
+        mem = gc.mem_alloc()
+        loaded = snapshot.load(SNAPSHOT_FILE, crc, Domain)
+        if loaded is None:
+            return False
+        (name, settings, domains) = loaded
+        gc.collect()
+        if domains:
+            self.domain_size = (gc.mem_alloc() - mem) // len(domains)
+        self.set_config(name, settings, domains)
+        return True
+
+    def save_snapshot(self):
+        """Write the snapshot of the configuration after the configuration or patch file changed"""
+        crc = snapshot.source_crc((self.configfile, PATCH_FILE))
+        size = snapshot.save(SNAPSHOT_FILE, crc, self.name, self.settings, self.domains.values())
+        if size:
+            self.store.bytes_written += size
+        else:
+            log.warning("The configuration can't be saved as a snapshot, it is read from {} at boot", self.configfile)
+            if exists(SNAPSHOT_FILE):
+                os.remove(SNAPSHOT_FILE)
 
     def get_config(self, config_data):
         """Read configuration from dictionary pulled from json file or string
@@ -55,89 +286,396 @@ class WateringSystem:
             #    print("Error: Invalid mode (please choose \"local\" or \"network\")")
             #    return None
             # Get domain information
+            if check_settings(config_data) > 0:
+                return None
+            gc.collect()
+            mem = gc.mem_alloc()
+            compiled = []
             for d in config_data["domains"]:
+                compiled.append(compile_domain(d))
+                if compiled[-1] is None:
+                    return None
+            # Create the new domains and their pins first, an invalid pin leaves the running ones alone
+            for (d, c) in zip(config_data["domains"], compiled):
                 domains[d["name"]] = Domain(d["name"], d["gpio"], d["duration"])
-                # Check if there is a schedule associated with the domain
-                if "schedule" in d:
-                    schd = d["schedule"]                        
-                    ret = domains[d["name"]].add_schedule(schd)
-                    if ret > 0:
-                        return None
+                domains[d["name"]].configure(d["duration"], c)
+            gc.collect()
+            if domains:
+                self.domain_size = (gc.mem_alloc() - mem) // len(domains)
+            # The configuration is valid, stop the domains it replaces
+            self.stop_domains(self.domains.values())
                 
-            # Update the class members
-            self.domains = domains
-            self.name = name
+            # Settings are the other top level keys (e.g. "uart")
+            self.set_config(name, dict((k, v) for (k, v) in config_data.items() if k != "name" and k != "domains"), domains)
             return config_data
         
         except:
             return None
+
+    def set_config(self, name, settings, domains):
+        """Replace the domains and settings with newly built ones"""
+        self.apply_settings(settings, domains.values())
+        # Update the class members
+        self.domains = domains
+        self.name = name
+        self.settings = settings
+
+    def stop_domains(self, domains):
+        """Stop the running and queued waterings of domains that are being removed or replaced"""
+        # Drop the queued waterings first, so stopping the running ones doesn't start them
+        for d in domains:
+            self.queue.cancel(d)
+        for d in domains:
+            d.stop()
+
+    def config(self):
+        """Regenerate the configuration dictionary from the domains and settings"""
+        config_data = {"name": self.name, "domains": [d.config() for d in self.domains.values()]}
+        config_data.update(self.settings)
+        return config_data
+
+    def apply_settings(self, config_data, domains):
+        """Apply the top level settings of the configuration and attach the history and
+           runtime state to the given (new) domains"""
+        # Open the watering history, its size can be set with history_size
+        history_size = config_data.get("history_size", HISTORY_SIZE)
+        if self.history is None or self.history.capacity != history_size:
+            self.history = History(HISTORY_FILE, history_size, self.names)
+            for d in self.domains.values():
+                d.history = self.history
+        # Pumps allowed to run at once, e.g. {"max_running": 2, "current_budget": 1500}
+        pumps = config_data.get("pumps", {})
+        self.queue.max_running = pumps.get("max_running", 1)
+        self.queue.current_budget = pumps.get("current_budget")
+        self.queue.dispatch()
+        for d in domains:
+            d.history = self.history
+            d.store = self.store
+            d.queue = self.queue
+            d.usage = self.usage.get(d.name)
+            # Restore the last watering from before a reboot so it isn't repeated
+            last_watered = self.store.get("lw:" + d.name)
+            if last_watered:
+                d.last_watered = tuple(last_watered)
+        # Log levels and mirroring, see Log.configure
+        if logs.configure(config_data.get("log", {})) > 0:
+            log.error("Invalid log level in the log settings")
+        # Flush policy of the runtime state, e.g. {"flush_interval": 300, "flush_dirty": 20, "compact_size": 4096}
+        if "persist" in config_data:
+            self.store.set_policy(**config_data["persist"])
+
+    def replay_patches(self, config_data):
+        """Apply the patches saved by patch_config to the configuration read from the file"""
+        try:
+            with open(PATCH_FILE, "r") as f:
+                for line in f:
+                    try:
+                        config_data = patch_config_data(config_data, json.loads(line))
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        # Ignore a patch cut short by a power loss
+                        pass
+        except OSError:
+            pass
+        return config_data
+
+    def apply_patch(self, patch):
+        """Apply a configuration patch (see patch_config_data) to the running system, return the
+           number of domains changed or None if the patch is invalid.
+
+           Only the domains named in the patch are touched: a new duration or schedule is set on
+           the live Domain, and a Domain (and its Pin) is only created when it is added or its gpio
+           changes, so the other domains keep running undisturbed."""
+        if not self.configfile:
+            return None
+        try:
+            current = dict((d["name"], d) for d in self.config()["domains"])
+            config_data = patch_config_data(self.config(), patch)
+            name = config_data["name"]
+            if check_settings(config_data) > 0:
+                return None
+            new_domains = dict((d["name"], d) for d in config_data["domains"])
+            changes = []
+            for dname in current:
+                if dname not in new_domains:
+                    changes.append((dname, None, None))
+            for d in config_data["domains"]:
+                if d == current.get(d["name"]):
+                    continue
+                compiled = compile_domain(d)
+                if compiled is None:
+                    return None
+                changes.append((d["name"], d, compiled))
+            # Create the domains (and pins) that are added or get a new pin before changing anything,
+            # so an invalid pin leaves the system as it was
+            created = dict()
+            for (dname, d, compiled) in changes:
+                old = self.domains.get(dname)
+                if d is not None and (old is None or old.gpio != d["gpio"]):
+                    created[dname] = Domain(dname, d["gpio"], d["duration"])
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return None
+
+        # The patch is valid, stop the domains that are removed or get a new pin, then change the live domains
+        self.stop_domains([self.domains[dname] for (dname, d, compiled) in changes
+                           if dname in self.domains and (d is None or self.domains[dname].gpio != d["gpio"])])
+        domains = dict()
+        added = []
+        for d in config_data["domains"]:
+            domains[d["name"]] = self.domains.get(d["name"])
+        for (dname, d, compiled) in changes:
+            old = self.domains.get(dname)
+            if d is None:
+                continue
+            if dname in created:
+                domain = created[dname]
+                if old is not None:
+                    domain.last_watered = old.last_watered
+                    domain.history = old.history
+                    domain.store = old.store
+                    domain.queue = old.queue
+                    domain.usage = old.usage
+                else:
+                    added.append(domain)
+                domains[dname] = domain
+            domains[dname].configure(d["duration"], compiled)
+        self.domains = domains
+        self.apply_settings(config_data, added)
+        self.name = name
+        self.settings = dict((k, v) for (k, v) in config_data.items() if k != "name" and k != "domains")
+        self.save_patch(patch)
+        self.save_snapshot()
+        return len(changes)
+
+    def save_patch(self, patch):
+        """Append the patch to the patch file, or fold all patches into the config file
+           once the patch file is large"""
+        line = json.dumps(patch) + "\n"
+        try:
+            size = os.stat(PATCH_FILE)[6]
+        except OSError:
+            size = 0
+        if size + len(line) > PATCH_COMPACT_SIZE:
+            # Patch the source rather than dump config(), which has the interval rules expanded
+            # and only the keys the domains use
+            with open(self.configfile, "r") as f:
+                config_data = patch_config_data(self.replay_patches(json.load(f)), patch)
+            self.store.bytes_written += atomic_write(self.configfile, json.dumps(config_data))
+            os.remove(PATCH_FILE)
+        else:
+            with open(PATCH_FILE, "a") as f:
+                f.write(line)
+            self.store.bytes_written += len(line)
+
+    def patch_config(self, json_string):
+        """Patch the configuration using json_string, see patch_config_data"""
+        try:
+            patch = json.loads(json_string)
+        except ValueError:
+            patch = None
+        n = self.apply_patch(patch) if isinstance(patch, dict) else None
+        if n is None:
+            ret_str = "Failed to patch configuration"
+        else:
+            ret_str = "Successfully patched configuration, {} domain(s) changed".format(n)
+        log.info(ret_str)
+        return ret_str
             
     def water_domain(self, name, duration=None):
+        """Start watering a domain in the background and return a status string"""
         if name in self.domains:
-            ret_str = self.domains[name].water(duration)
-            #ret_str = "Watered domain {}".format(name)
+            d = self.domains[name]
+            if d.is_running():
+                ret_str = "Domain \"{}\" is already being watered".format(name)
+            elif not d.start_watering(duration):
+                ret_str = "Domain \"{}\" is already waiting to be watered".format(name)
+            elif d.is_running():
+                ret_str = "Started watering domain \"{}\" for {} seconds".format(name, duration if duration else d.duration)
+            else:
+                ret_str = "Queued watering of domain \"{}\" until a pump is free".format(name)
+        else:
+            ret_str = "There is no domain \"{}\" defined in the watering system".format(name)
+        
+        log.info(ret_str)
+        return ret_str
+    
+    def stop_domain(self, name):
+        """Stop watering a domain (or all domains if name is "all") and return a status string"""
+        if name == "all":
+            stopped = [d.name for d in self.domains.values() if d.stop()]
+            if stopped:
+                ret_str = "Stopped watering domains: {}".format(", ".join(stopped))
+            else:
+                ret_str = "No domains are being watered"
+        elif name in self.domains:
+            if self.domains[name].stop():
+                ret_str = "Stopped watering domain \"{}\"".format(name)
+            else:
+                ret_str = "Domain \"{}\" is not being watered".format(name)
         else:
             ret_str = "There is no domain \"{}\" defined in the watering system".format(name)
         
-        print(ret_str)
+        log.info(ret_str)
         return ret_str
     
+    def history_entries(self, name=None, n=10):
+        """Generate the newest n (time.localtime() tuple, domain name, duration, source) waterings,
+           optionally only for domain name"""
+        if self.history is None:
+            return
+        for (t, did, duration, source) in self.history.records(name, n):
+            yield (time.localtime(t), self.names.name(did) or "#{}".format(did), duration, source2name[source])
+    
+    def history_lines(self, name=None, n=10):
+        """Generate the newest n lines of watering history, optionally only for domain name"""
+        for (t, name, duration, source) in self.history_entries(name, n):
+            (year, month, mday, h, m, s, wday, yrday) = t
+            yield "{} {:02}-{:02}-{:04} @ {:02}:{:02}:{:02} \"{}\" watered for {} seconds ({})\n".format(
+                number2weekday[wday], month, mday, year, h, m, s, name, duration, source)
+    
+    def usage_totals(self, name=None, days=7):
+        """Generate (domain name, runs, seconds, liters or None) over the last days days for
+           a domain or all of them, from the rolling totals kept by each domain"""
+        (year, month, mday, h, m, s, wday, yrday) = time.localtime()
+        today = day_number(year, month, mday)
+        for d in self.domains.values():
+            if name is None or d.name == name:
+                (runs, seconds) = d.usage.total(today, days)
+                yield (d.name, runs, seconds, seconds * d.flow / 60 if d.flow else None)
+
+    def usage_lines(self, name=None, days=7):
+        """Generate the lines of a usage report, see usage_totals"""
+        if name is not None and name not in self.domains:
+            yield "There is no domain \"{}\" defined in the watering system\n".format(name)
+            return
+        days = min(max(days, 1), WEEKS * 7)
+        if days <= DAYS:
+            yield "Usage over the last {} day(s):\n".format(days)
+        else:
+            yield "Usage over the last {} week(s), from Monday:\n".format((days + 6) // 7)
+        total = [0, 0, 0]
+        for (dname, runs, seconds, liters) in self.usage_totals(name, days):
+            yield "  {:<20}: {:>4} runs, {:>8.1f} min, {} liters\n".format(dname, runs, seconds / 60, "-" if liters is None else "{:.1f}".format(liters))
+            total[0] += runs
+            total[1] += seconds
+            total[2] += liters or 0
+        if name is None:
+            yield "  {:<20}: {:>4} runs, {:>8.1f} min, {:.1f} liters\n".format("Total", total[0], total[1] / 60, total[2])
+
+    def storage_info(self):
+        """Return a string with the flash usage of the runtime state, history and configuration"""
+        s = "Runtime state: {} keys, {} unsaved, journal {} bytes, {} flushes\n".format(len(self.store.state), len(self.store.dirty), self.store.journal_size, self.store.flushes)
+        history_bytes = self.history.bytes_written if self.history else 0
+        total = self.store.bytes_written + history_bytes + self.usage.bytes_written + self.names.bytes_written
+        s += "Bytes written: {} (state and configuration {}, history {}, usage {}, names {})\n".format(total, self.store.bytes_written, history_bytes, self.usage.bytes_written, self.names.bytes_written)
+        s += "Bytes written per hour: {}\n".format(int(total * 3600 // max(self.store.uptime, 1)))
+        return s
+    
     def check_schedule(self, curr_dt):
         """Provided the current date and time from time.localtime(), check the schedule for all domains and water"""
         for d in self.domains.values():
             ret_str = d.check_schedule(curr_dt)
-            print(ret_str)
+            if ret_str:
+                log.info(ret_str)
                 
+    def info_lines(self, name=None):
+        """Generate the information about the watering domains (or only domain name) line by line"""
+        if not self.configfile:
+            yield "Watering sytem is not configured yet.  Please run update_config.\n"
+            return
+        if name is None:
+            yield "Name: {}\n".format(self.name)
+            yield "Configuration file: {}\n".format(self.configfile)
+            yield "There are {} watering domains configured:\n".format(len(self.domains))
+        elif name not in self.domains:
+            yield "There is no domain \"{}\" defined in the watering system\n".format(name)
+            return
+        # The domains can change while the lines are written out
+        for d in (tuple(self.domains.values()) if name is None else (self.domains[name],)):
+            for line in d.info_lines():
+                yield line
+
     def print_info(self):
-        """Print information about the watering domains and return the string"""
-        s = "Name: {}\n".format(self.name)
-        if self.configfile:
-            s += "Configuration file: {}\n".format(self.configfile)
-            s += "There are {} watering domains configured:\n".format(len(self.domains))
-            for d in self.domains.values():
-                s += " * Domain \"{}\" is using GPIO {} and has a watering duration of {} seconds\n".format(d.name, d.gpio, d.duration)
-                if d.last_watered:
-                    (year, month, mday, h, m, wday) = d.last_watered
-                    s += "  * Last watered: {} {:02}-{:02}-{:04} @ {:02}:{:02}\n".format(number2weekday[wday], month, mday, year, h, m)
-                if d.schd:
-                    s += "  * Watering Schedule\n"
-                    for (weekday, times) in d.schd.items():
-                        times_formatted = ["{:02}:{:02}".format(h,m) for h, m in times]
-                        s += "   * {} @ {}\n".format(weekday, ",".join(times_formatted))
-                else:
-                    s += "  * No watering schedule specified in configuration.\n"
-        else:
-            s = "Watering sytem is not configured yet.  Please run update_config.\n"
-        print(s)
-        return s
-                
+        """Return the information about the watering domains as one string"""
+        return "".join(self.info_lines())
+
+    def config_lines(self):
+        """Generate the json configuration a domain at a time, the same text as json.dumps(self.config())"""
+        if not self.configfile:
+            yield "Watering sytem is not configured yet.  Please run update_config.\n"
+            return
+        yield "Configuration file: {}\n".format(self.configfile)
+        yield "{\"name\": " + json.dumps(self.name) + ", \"domains\": ["
+        sep = ""
+        for d in tuple(self.domains.values()):
+            yield sep + json.dumps(d.config())
+            sep = ", "
+        yield "]"
+        for (k, v) in self.settings.items():
+            yield ", " + json.dumps(k) + ": " + json.dumps(v)
+        yield "}"
+
     def print_config(self):
-        """Print the json configuration file and return the string"""
-        if self.configfile:
-            json_str = json.dumps(self.config_data)
-            print(json_str)
-            return "Configuration file: {}\n".format(self.configfile) + json_str
-        else:
-            return "Watering sytem is not configured yet.  Please run update_config.\n"
+        """Return the json configuration as one string"""
+        return "".join(self.config_lines())
         
-    def update_config(self, json_string):
-        """Update the config file using json_string"""
-        data = self.get_config(json.loads(json_string))
+    def apply_config(self, config_data):
+        """Update the configuration from a dictionary and save it to the config file, return True if succesful"""
+        data = self.get_config(config_data)
         if data:
-            self.config_data = data
             if self.configfile is None:
                 self.configfile = "config.json"
-            with open(self.configfile, "w") as f:
-                json.dump(data, f)
+            self.store.bytes_written += atomic_write(self.configfile, json.dumps(data))
+            # The saved patches are part of the new configuration file now
+            if exists(PATCH_FILE):
+                os.remove(PATCH_FILE)
+            self.save_snapshot()
+            return True
+        return False
+        
+    async def sample_sensors(self):
+        """Read the soil sensors of all domains every sensor_interval seconds (default 10)"""
+        while(True):
+            for d in tuple(self.domains.values()):
+                if d.sensor is not None:
+                    d.sensor.sample()
+                    # Let other tasks run between sensors
+                    await asyncio.sleep(0)
+            await asyncio.sleep(self.settings.get("sensor_interval", 10))
+
+    def memory_lines(self):
+        """Generate the lines about the free heap and the memory used by the domains"""
+        gc.collect()
+        free = gc.mem_free()
+        yield "Heap: {} bytes free, {} bytes allocated\n".format(free, gc.mem_alloc())
+        if self.domain_size:
+            yield "Domains: {} using about {} bytes each, room for about {} more\n".format(len(self.domains), self.domain_size, free // self.domain_size)
+        for d in tuple(self.domains.values()):
+            n = d.schd.count if d.schd else 0
+            yield "  {}: {} watering times ({} bytes)\n".format(d.name, n, 2 * n)
+
+    def memory_info(self):
+        """Return a string with the free heap and the memory used by the domains"""
+        return "".join(self.memory_lines())
+
+    def update_config(self, json_string):
+        """Update the config file using json_string"""
+        try:
+            config_data = json.loads(json_string)
+        except ValueError:
+            config_data = None
+        if config_data is not None and self.apply_config(config_data):
             ret_str = "Successfully updated configuration and saved to {}".format(self.configfile)
         else:
             ret_str = "Failed to update configuration"
         
-        print(ret_str)
+        log.info(ret_str)
         return ret_str
                 
             
 class Domain:
+    __slots__ = ("name", "gpio", "duration", "pump", "schd", "last_watered", "task", "missed", "sensor", "current",
+                 "flow", "history", "store", "queue", "usage")
+
     def __init__(self, name, gpio, duration):
         self.name = name
         self.gpio = gpio
@@ -145,77 +683,233 @@ class Domain:
         self.pump = Pin(gpio, Pin.OUT, value=0)
         self.schd = None
         self.last_watered = None
-        print("Created \"{}\" domain using GPIO {}".format(name, gpio))
+        self.task = None
+        self.missed = "skip"
+        self.sensor = None
+        self.current = 0
+        self.flow = 0
+        self.history = None
+        self.store = None
+        self.queue = None
+        self.usage = None
+        log.debug("Created \"{}\" domain using GPIO {}", name, gpio)
         
-    def add_schedule(self, schd):
+    def configure(self, duration, compiled):
+        """Set the duration and the settings returned by compile_domain"""
+        self.duration = duration
+        (self.schd, self.missed, self.sensor, self.current, self.flow) = compiled
+
+    def add_schedule(self, schd, every_days=None, start_date=None, season=None):
         """ Add schedule taken from the config file to the domain.
             Schedule is a list of dictionaries each with format { weekday => DAYOFWEEK, times => [hr:min, hr:min, ...] }
+            or { weekday => DAYOFWEEK, every => hr:min, from => hr:min, to => hr:min }, see Schedule for details.
+            Optionally only water every every_days days from start_date and between the season dates.
         """
-        domain_schd = dict()
-        for entry in schd:
-            weekday = entry["weekday"]
-            if weekday in weekday2number:
-                domain_schd[weekday] = []
-                for t in entry["times"]:
-                    (h, m) = t.split(":")
-                    h = int(h)
-                    m = int(m)
-                    if (h >= 0) and (h < 24) and (m >= 0) and (m < 60):
-                        domain_schd[weekday].append((h,m))
-                    else:
-                        print("Error: times must be in the format hr:min where hr is between 0 and 23 and min between 0 and 59.")
-                        return 1
-                
-            else:
-                print("Error: {} is not a properly formatted day of the week".format(weekday))
-                return 1
-            
-        self.schd = domain_schd
+        domain_schd = compile_schedule(schd, every_days, start_date, season)
+        if domain_schd is None:
+            return 1
+        self.schd = domain_schd if domain_schd.count else None
         return 0
     
+    def is_due(self, curr_dt):
+        """Provided the current date and time from time.localtime(), check if a watering is scheduled"""
+        return self.schd is not None and self.schd.due(curr_dt)
+    
     def check_schedule(self, curr_dt):
         """Provided the current date and time from time.localtime(), check the schedule and water"""
-        if self.schd:
-            (year, month, mday, h, m, s, wday, yrday) = curr_dt
-            # Don't water if we already watered
-            if self.last_watered:
-                if (year, month, mday, h, m, wday) == self.last_watered:
-                    return ""
-            if number2weekday[wday] in self.schd:
-                for t in self.schd[number2weekday[wday]]:
-                    if t == (h, m):
-                        ret_str = self.water()
-                        return ret_str
+        if self.is_due(curr_dt):
+            return self.water_scheduled(curr_dt)
         return ""
+    
+    def water_scheduled(self, curr_dt):
+        """Start the watering scheduled at curr_dt unless it is running or already done"""
+        (year, month, mday, h, m, s, wday, yrday) = curr_dt
+        # Don't water if it is not a watering day, we are watering or already watered
+        if not self.schd.day_allowed(year, month, mday):
+            return ""
+        if self.is_running():
+            return ""
+        if self.last_watered:
+            if (year, month, mday, h, m, wday) == self.last_watered:
+                return ""
+        return self.start_scheduled()
+
+    def start_scheduled(self):
+        """Start a scheduled watering, skipped or shortened if the soil sensor reads moist"""
+        duration = self.duration
+        if self.sensor is not None:
+            duration = self.sensor.adjust(self.duration)
+            if not duration:
+                metrics.counter("skipped." + self.name).inc()
+                return "Skipped scheduled watering of domain \"{}\", soil moisture {}%".format(self.name, self.sensor.moisture())
+        if not self.start_watering(duration, SOURCE_SCHEDULED):
+            return ""
+        if not self.is_running():
+            return "Queued scheduled watering of domain \"{}\" for {} seconds".format(self.name, duration)
+        return "Started scheduled watering of domain \"{}\" for {} seconds".format(self.name, duration)
         
-    def water(self, duration=None):
+    def water(self, duration=None, source=SOURCE_MANUAL):
+        if not duration:
+            duration = self.duration
         self.pump.value(1)
-        if duration:
-            time.sleep(duration)
+        time.sleep(duration)
+        self.pump.value(0)
+        
+        return self.record_watering(duration, source)
+    
+    async def water_async(self, duration=None, source=SOURCE_MANUAL):
+        """Turn the pump on, yield to the event loop for the watering duration and turn it off.
+           The pump is always turned off, its queue slot freed and the watering recorded, even
+           if cancelled. A watering that can't be recorded is logged and still frees its slot."""
+        if not duration:
+            duration = self.duration
+        task = self.task
+        start = time.ticks_ms()
+        self.pump.value(1)
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            # stop() has already turned off and released a stopped watering, and the
+            # domain may be watering again by the time the cancelled task gets here
+            if self.task is task:
+                try:
+                    self.pump.value(0)
+                finally:
+                    if self.queue is not None:
+                        self.queue.finished(self)
+            # A failure to record the watering mustn't stop the task from ending
+            try:
+                ret_str = self.record_watering(min(time.ticks_diff(time.ticks_ms(), start) / 1000, duration), source)
+                log.info(ret_str.rstrip())
+            except Exception as e:
+                ret_str = "Failed to record the watering of domain \"{}\": {!r}".format(self.name, e)
+                log.error(ret_str)
+        return ret_str
+    
+    def start_watering(self, duration=None, source=SOURCE_MANUAL):
+        """Water through the job queue (or right away without one), return False if the
+           domain is already running or queued"""
+        if self.queue is not None:
+            return self.queue.submit(self, duration, source)
+        if self.is_running():
+            return False
+        self.start_task(duration, source)
+        return True
+
+    def start_task(self, duration=None, source=SOURCE_MANUAL):
+        """Launch water_async as a background task"""
+        self.task = asyncio.create_task(self.water_async(duration, source))
+        return self.task
+    
+    def is_running(self):
+        return self.task is not None and not self.task.done()
+
+    def is_queued(self):
+        return self.queue is not None and self.queue.is_queued(self)
+    
+    def state(self):
+        """Return a dictionary with the configuration and state of the domain"""
+        state = {"name": self.name, "gpio": self.gpio, "duration": self.duration, "running": self.is_running(),
+                 "queued": self.is_queued(), "last_watered": list(self.last_watered) if self.last_watered else None,
+                 "missed": self.missed}
+        if self.sensor:
+            state["moisture"] = self.sensor.moisture()
+        if self.schd:
+            schedule = dict()
+            for wday in range(7):
+                times = self.schd.times(wday)
+                if times:
+                    schedule[number2weekday[wday]] = ["{:02}:{:02}".format(h, m) for (h, m) in times]
+            state["schedule"] = schedule
+            if self.schd.every_days > 1:
+                state["every_days"] = self.schd.every_days
+            if self.schd.season:
+                state["season"] = ["{:02}-{:02}".format(md // 32, md % 32) for md in self.schd.season]
+        return state
+    
+    def info_lines(self):
+        """Generate the description of the domain and its schedule"""
+        yield " * Domain \"{}\" is using GPIO {} and has a watering duration of {} seconds\n".format(self.name, self.gpio, self.duration)
+        if self.is_running():
+            yield "  * Currently watering\n"
+        elif self.is_queued():
+            yield "  * Waiting for a pump to be free\n"
+        if self.sensor:
+            if self.sensor.raw() is None:
+                yield "  * Soil moisture: not read yet\n"
+            else:
+                yield "  * Soil moisture: {}% (reading {})\n".format(self.sensor.moisture(), self.sensor.raw())
+        if self.last_watered:
+            (year, month, mday, h, m, wday) = self.last_watered
+            yield "  * Last watered: {} {:02}-{:02}-{:04} @ {:02}:{:02}\n".format(number2weekday[wday], month, mday, year, h, m)
+        if self.schd:
+            yield "  * Watering Schedule\n"
+            for wday in range(7):
+                times = self.schd.times(wday)
+                if times:
+                    yield "   * {} @ {}\n".format(number2weekday[wday], ",".join(["{:02}:{:02}".format(h, m) for (h, m) in times]))
+            if self.schd.every_days > 1:
+                yield "   * Every {} days\n".format(self.schd.every_days)
+            if self.schd.season:
+                (start, end) = self.schd.season
+                yield "   * From {:02}-{:02} to {:02}-{:02}\n".format(start // 32, start % 32, end // 32, end % 32)
         else:
-            time.sleep(self.duration)
+            yield "  * No watering schedule specified in configuration.\n"
+
+    def config(self):
+        """Return the configuration dictionary of the domain"""
+        config = {"name": self.name, "gpio": self.gpio, "duration": self.duration}
+        if self.missed != "skip":
+            config["missed"] = self.missed
+        if self.schd:
+            config["schedule"] = self.schd.config()
+            if self.schd.every_days:
+                config["every_days"] = self.schd.every_days
+                if self.schd.start_day:
+                    config["start_date"] = date_string(self.schd.start_day)
+            if self.schd.season:
+                config["season"] = ["{:02}-{:02}".format(md // 32, md % 32) for md in self.schd.season]
+        if self.sensor:
+            config["sensor"] = self.sensor.config()
+        if self.current:
+            config["current"] = self.current
+        if self.flow:
+            config["flow"] = self.flow
+        return config
+
+    def stop(self):
+        """Cancel a watering in progress or queued, return True if there was one"""
+        if self.queue is not None and self.queue.cancel(self):
+            return True
+        if not self.is_running():
+            return False
         self.pump.value(0)
+        self.task.cancel()
+        # The cancelled task only ends when it next runs, the domain is free right away
+        self.task = None
+        # A task cancelled before it started never reaches its finally
+        if self.queue is not None:
+            self.queue.finished(self)
+        return True
         
-        # Record the time of watering
+    def record_watering(self, duration, source=SOURCE_MANUAL):
+        """Record the time of watering in last_watered, the usage totals, the runtime state
+           and the history file. The history goes last, as writing a file is the most likely
+           to fail and the other records shouldn't be lost with it."""
         (year, month, mday, h, m, s, wday, yrday) = time.localtime()
         self.last_watered = (year, month, mday, h, m, wday)
         
         ret_str = "Watered domain \"{}\" on {} {:02}-{:02}-{:04} @ {:02}:{:02}\n".format(self.name, number2weekday[wday], month, mday, year, h, m)
         
-        if exists("history.txt"):
-            wf = open("history.txt", "r")
-            log = wf.readlines()
-            print(log)
-            wf.close()
-            if len(log) > 10:
-                wf = open("history.txt", "w")
-                for l in log[5:]:
-                    wf.write(l) 
-                wf.close()
-        
-        wf = open("history.txt", "a")
-        wf.write(ret_str)
-        wf.close()
+        if self.usage is not None:
+            self.usage.record(day_number(year, month, mday), duration)
+        if self.store is not None:
+            self.store.set("lw:" + self.name, list(self.last_watered), urgent=True)
+            self.store.set("waterings", self.store.get("waterings", 0) + 1)
+        metrics.counter("waterings." + self.name).inc()
+        metrics.counter("water_s." + self.name).inc(duration)
+        if self.history is not None:
+            self.history.append(self.name, duration, source)
         
         return ret_str
 
@@ -285,14 +979,13 @@ def test_pump_schd():
                 {
                     "weekday": "WED",
                     "times": ["17:00"]
-                },
-                
+                }
             ]
         },
         {
             "name": "succulents",
             "gpio": 1,
-            "duration": 5
+            "duration": 5,
             "schedule": [
                 {
                     "weekday": "SUN",
@@ -301,8 +994,7 @@ def test_pump_schd():
                 {
                     "weekday": "WED",
                     "times": ["17:00"]
-                },
-                
+                }
             ]
         }
     ]
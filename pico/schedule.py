@@ -0,0 +1,222 @@
+from array import array
+from log import get_logger
+
+log = get_logger("schedule")
+
+number2weekday = ["MON", "TUE", "WED", "THU", "FRI", "SAT", "SUN"]
+weekday2number = {"MON": 0, "TUE": 1, "WED": 2, "THU": 3, "FRI": 4, "SAT": 5, "SUN": 6}
+
+MINUTES_PER_DAY = 1440
+MINUTES_PER_WEEK = 10080
+
+def day_number(year, month, mday):
+    """Number of days since 2000-01-01"""
+    if month <= 2:
+        year -= 1
+        month += 12
+    return 365 * year + year // 4 - year // 100 + year // 400 + (153 * (month - 3) + 2) // 5 + mday - 730426
+
+def parse_time(t):
+    """Convert "hr:min" to minutes since midnight, or None if it is not a valid time"""
+    try:
+        (h, m) = t.split(":")
+        h = int(h)
+        m = int(m)
+    except:
+        return None
+    if (h >= 0) and (h < 24) and (m >= 0) and (m < 60):
+        return h * 60 + m
+    return None
+
+def parse_date(d):
+    """Convert "YYYY-MM-DD" to a day number, or None if it is not a valid date"""
+    try:
+        (year, month, mday) = [int(s) for s in d.split("-")]
+    except:
+        return None
+    if (month < 1) or (month > 12) or (mday < 1) or (mday > 31):
+        return None
+    return day_number(year, month, mday)
+
+def parse_month_day(d):
+    """Convert "MM-DD" to month * 32 + day, or None if it is not a valid date"""
+    try:
+        (month, mday) = [int(s) for s in d.split("-")]
+    except:
+        return None
+    if (month < 1) or (month > 12) or (mday < 1) or (mday > 31):
+        return None
+    return month * 32 + mday
+
+def date_string(day):
+    """Convert a day number back to a "YYYY-MM-DD" string"""
+    # Days since 0000-03-01, then 400 year eras of 146097 days as in day_number
+    day += 730425
+    era = day // 146097
+    doe = day - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    mday = doy - (153 * mp + 2) // 5 + 1
+    month = mp + 3 if mp < 10 else mp - 9
+    year = era * 400 + yoe + (1 if month <= 2 else 0)
+    return "{:04}-{:02}-{:02}".format(year, month, mday)
+
+def search(a, x):
+    """Index of the first element of the sorted array a that is >= x"""
+    lo = 0
+    hi = len(a)
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if a[mid] < x:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+class Schedule:
+    """Weekly watering schedule compiled into a sorted array of minutes of the week (two bytes
+       per watering time), plus optional every-N-days and seasonal date range filters, so
+       checking if it is due is a binary search.
+
+       Each entry of the schedule list in the configuration has a "weekday" (a day name,
+       a list of day names or "*" for every day) and either a list of "times" ("hr:min")
+       or an "every" interval ("hr:min") between "from" and "to" (default 00:00 to 23:59)."""
+    __slots__ = ("minutes", "every_days", "start_day", "season")
+
+    def __init__(self):
+        self.minutes = array("H")
+        self.every_days = 0
+        self.start_day = 0
+        self.season = None
+
+    @property
+    def count(self):
+        return len(self.minutes)
+
+    def is_set(self, mow):
+        i = search(self.minutes, mow)
+        return i < len(self.minutes) and self.minutes[i] == mow
+
+    def add_entry(self, entry):
+        """Add one schedule entry from the configuration, return 1 on error"""
+        weekday = entry["weekday"]
+        if weekday == "*":
+            days = range(7)
+        else:
+            if isinstance(weekday, str):
+                weekday = [weekday]
+            days = []
+            for w in weekday:
+                if w not in weekday2number:
+                    log.error("{} is not a properly formatted day of the week", w)
+                    return 1
+                days.append(weekday2number[w])
+
+        if "every" in entry:
+            every = parse_time(entry["every"])
+            start = parse_time(entry.get("from", "00:00"))
+            end = parse_time(entry.get("to", "23:59"))
+            if not every or start is None or end is None:
+                log.error("every, from and to must be in the format hr:min and every cannot be 00:00")
+                return 1
+            minutes = range(start, end + 1, every)
+        else:
+            minutes = []
+            for t in entry["times"]:
+                m = parse_time(t)
+                if m is None:
+                    log.error("times must be in the format hr:min where hr is between 0 and 23 and min between 0 and 59")
+                    return 1
+                minutes.append(m)
+
+        mows = set(self.minutes)
+        for day in days:
+            for m in minutes:
+                mows.add(day * MINUTES_PER_DAY + m)
+        self.minutes = array("H", sorted(mows))
+        return 0
+
+    def set_every_days(self, every_days, start_date=None):
+        """Only water every every_days days counting from start_date ("YYYY-MM-DD"), return 1 on error"""
+        start_day = 0
+        if start_date is not None:
+            start_day = parse_date(start_date)
+        if not isinstance(every_days, int) or every_days < 1 or start_day is None:
+            log.error("every_days must be a positive integer and start_date in the format YYYY-MM-DD")
+            return 1
+        self.every_days = every_days
+        self.start_day = start_day
+        return 0
+
+    def set_season(self, season):
+        """Only water between two "MM-DD" dates (inclusive, may wrap around the new year), return 1 on error"""
+        try:
+            (start, end) = [parse_month_day(d) for d in season]
+        except:
+            start = None
+            end = None
+        if start is None or end is None:
+            log.error("season must be a list of two dates in the format MM-DD")
+            return 1
+        self.season = (start, end)
+        return 0
+
+    def day_allowed(self, year, month, mday):
+        """Check the every-N-days and seasonal filters for a date"""
+        if self.every_days > 1:
+            if (day_number(year, month, mday) - self.start_day) % self.every_days:
+                return False
+        if self.season:
+            (start, end) = self.season
+            md = month * 32 + mday
+            if start <= end:
+                return start <= md <= end
+            return md >= start or md <= end
+        return True
+
+    def due(self, curr_dt):
+        """Provided the current date and time from time.localtime(), check if watering is due"""
+        (year, month, mday, h, m, s, wday, yrday) = curr_dt
+        if not self.is_set(wday * MINUTES_PER_DAY + h * 60 + m):
+            return False
+        return self.day_allowed(year, month, mday)
+
+    def minutes_to_next(self, mow):
+        """Minutes from the minute of the week mow to the next set minute at or after it,
+           wrapping around the end of the week (the schedule must not be empty)"""
+        i = search(self.minutes, mow)
+        if i < len(self.minutes):
+            return self.minutes[i] - mow
+        return self.minutes[0] + MINUTES_PER_WEEK - mow
+
+    def slots(self, first_day=0, ndays=7):
+        """Return the minutes of the week that are set on ndays days starting with first_day"""
+        return self.minutes[search(self.minutes, first_day * MINUTES_PER_DAY):search(self.minutes, (first_day + ndays) * MINUTES_PER_DAY)]
+
+    def times(self, wday):
+        """Return the (hr, min) times set on a day of the week"""
+        times = []
+        for mow in self.slots(wday, 1):
+            m = mow % MINUTES_PER_DAY
+            times.append((m // 60, m % 60))
+        return times
+
+    def config(self):
+        """Return the schedule entries for the configuration, with one entry per set of times
+           shared by several days"""
+        entries = []
+        for wday in range(7):
+            times = ["{:02}:{:02}".format(h, m) for (h, m) in self.times(wday)]
+            if not times:
+                continue
+            for entry in entries:
+                if entry["times"] == times:
+                    entry["weekday"].append(number2weekday[wday])
+                    break
+            else:
+                entries.append({"weekday": [number2weekday[wday]], "times": times})
+        for entry in entries:
+            if len(entry["weekday"]) == 7:
+                entry["weekday"] = "*"
+        return entries
@@ -0,0 +1,121 @@
+import time
+import heapq
+import uasyncio as asyncio
+from schedule import MINUTES_PER_DAY, MINUTES_PER_WEEK
+from metrics import metrics, SECONDS_BUCKETS
+from log import get_logger
+
+log = get_logger("scheduler")
+
+# Longest time the scheduler sleeps without looking at the clock, in case it is
+# changed without the scheduler being told
+MAX_SLEEP = 3600
+
+def minute_of_week(t):
+    """Minute of the week (Monday 00:00 is 0) of a time.localtime() tuple"""
+    (year, month, mday, h, m, s, wday, yrday) = t
+    return wday * MINUTES_PER_DAY + h * 60 + m
+
+class Scheduler:
+    """Sleep until the next scheduled watering of any domain instead of polling.
+
+       The heap holds one (minute, domain name) entry per domain, keyed by the absolute
+       minute (time.time() // 60) of its next slot, found with a binary search of the
+       domain's schedule. When the slot fires, the domain's following slot is pushed.
+       When the clock jumps forward past slots, each domain's missed policy decides
+       whether they are run late ("run") or dropped ("skip")."""
+    def __init__(self, ws):
+        self.ws = ws
+        self.heap = []
+        self.last_min = None    # last minute that has been handled
+        self.wake = asyncio.Event()
+        # Seconds between a scheduled minute and the start of its watering
+        self.late = metrics.histogram("schedule_late_s", SECONDS_BUCKETS)
+        self.missed = metrics.counter("missed_runs")
+
+    def next_slot(self, d, t):
+        """Absolute minute of the first slot of domain d at or after minute t, or None"""
+        if d.schd is None:
+            return None
+        return t + d.schd.minutes_to_next(minute_of_week(time.localtime(t * 60)))
+
+    def push(self, d, t):
+        """Queue the first slot of domain d at or after minute t"""
+        t = self.next_slot(d, t)
+        if t is not None:
+            heapq.heappush(self.heap, (t, d.name))
+
+    def rebuild(self):
+        """Rebuild the heap from the domain schedules (call after the configuration changes)"""
+        if self.last_min is None:
+            start = time.time() // 60
+        else:
+            start = self.last_min + 1
+        heap = []
+        for d in self.ws.domains.values():
+            t = self.next_slot(d, start)
+            if t is not None:
+                heap.append((t, d.name))
+        heapq.heapify(heap)
+        self.heap = heap
+        self.wake.set()
+
+    def clock_changed(self):
+        """Wake the scheduler to look for slots skipped over by a change of the clock"""
+        self.wake.set()
+
+    def fire(self, now):
+        """Start the waterings due at minute now and handle any slots missed since the last call"""
+        if self.last_min is None or now < self.last_min:
+            # First run or the clock went backwards, start again from now
+            self.last_min = now - 1
+            self.rebuild()
+        elif now - self.last_min > 1:
+            # The clock jumped forward, run each domain with missed slots at most once
+            late = []
+            while self.heap and self.heap[0][0] < now:
+                (t, name) = heapq.heappop(self.heap)
+                d = self.ws.domains.get(name)
+                if d is None:
+                    continue
+                # Look for a missed slot on a watering day, over at most a week
+                end = min(now, t + MINUTES_PER_WEEK)
+                while t is not None and t < end:
+                    if d.is_due(time.localtime(t * 60)):
+                        late.append(d)
+                        break
+                    t = self.next_slot(d, t + 1)
+                self.push(d, now)
+            for d in late:
+                if d.missed == "run" and not d.is_running():
+                    log.info("Running missed watering of domain \"{}\"", d.name)
+                    log.info(d.start_scheduled())
+                    self.missed.inc()
+
+        while self.heap and self.heap[0][0] <= now:
+            (t, name) = heapq.heappop(self.heap)
+            d = self.ws.domains.get(name)
+            if d is None:
+                continue
+            self.push(d, t + 1)
+            if t == now:
+                ret_str = d.water_scheduled(time.localtime(t * 60))
+                if ret_str:
+                    self.late.observe(time.time() - t * 60)
+                    log.info(ret_str)
+        self.last_min = now
+
+    def seconds_to_next(self):
+        """Seconds until the next slot is due"""
+        if not self.heap:
+            return MAX_SLEEP
+        return min(max(self.heap[0][0] * 60 - time.time(), 0), MAX_SLEEP)
+
+    async def run(self):
+        while(True):
+            self.wake.clear()
+            self.fire(time.time() // 60)
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.seconds_to_next())
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,97 @@
+from machine import ADC, Pin
+from array import array
+
+# The moving average is kept in 1/16ths of an ADC step
+SHIFT = 4
+
+class Sensor:
+    """Soil moisture sensor on an ADC pin.
+
+       Each sample() reads a batch of readings into a preallocated buffer, drops the lowest
+       and highest and folds the mean into an integer exponential moving average, so sampling
+       doesn't allocate. The average is converted to a moisture percentage with the "dry" and
+       "wet" calibration readings (either may be the larger one)."""
+    __slots__ = ("gpio", "adc", "buf", "avg", "dry", "wet", "skip_above", "shorten_above", "smoothing")
+
+    def __init__(self, gpio, dry=65535, wet=0, skip_above=None, shorten_above=None, samples=8, smoothing=2):
+        self.gpio = gpio
+        self.adc = ADC(Pin(gpio))
+        self.buf = array("H", bytes(2 * samples))
+        self.avg = None
+        self.dry = dry
+        self.wet = wet
+        self.skip_above = skip_above
+        self.shorten_above = shorten_above
+        # The average moves 1 / 2**smoothing of the way to each new batch mean
+        self.smoothing = smoothing
+
+    def sample(self):
+        buf = self.buf
+        for i in range(len(buf)):
+            buf[i] = self.adc.read_u16()
+        total = 0
+        lo = 65535
+        hi = 0
+        for v in buf:
+            total += v
+            if v < lo:
+                lo = v
+            if v > hi:
+                hi = v
+        if len(buf) > 2:
+            mean = (total - lo - hi) // (len(buf) - 2)
+        else:
+            mean = total // len(buf)
+        if self.avg is None:
+            self.avg = mean << SHIFT
+        else:
+            self.avg += ((mean << SHIFT) - self.avg) >> self.smoothing
+
+    def raw(self):
+        """Moving average of the readings, or None before the first sample"""
+        return None if self.avg is None else self.avg >> SHIFT
+
+    def moisture(self):
+        """Soil moisture in percent, or None before the first sample"""
+        if self.avg is None:
+            return None
+        m = (self.dry - (self.avg >> SHIFT)) * 100 // (self.dry - self.wet)
+        return min(max(m, 0), 100)
+
+    def adjust(self, duration):
+        """Duration of a scheduled watering given the soil moisture: 0 (skip) at or above
+           skip_above percent, and shortened in proportion between shorten_above and skip_above"""
+        m = self.moisture()
+        if m is None:
+            return duration
+        if self.skip_above is not None and m >= self.skip_above:
+            return 0
+        if self.shorten_above is not None and m > self.shorten_above:
+            top = 100 if self.skip_above is None else self.skip_above
+            return duration * (top - m) / (top - self.shorten_above)
+        return duration
+
+    def config(self):
+        config = {"gpio": self.gpio, "dry": self.dry, "wet": self.wet, "samples": len(self.buf)}
+        if self.skip_above is not None:
+            config["skip_above"] = self.skip_above
+        if self.shorten_above is not None:
+            config["shorten_above"] = self.shorten_above
+        return config
+
+def make_sensor(config):
+    """Create a Sensor from the "sensor" settings of a domain, e.g. {"gpio": 26, "dry": 52000,
+       "wet": 21000, "skip_above": 60, "shorten_above": 40, "samples": 8}, or return None if invalid"""
+    try:
+        dry = config.get("dry", 65535)
+        wet = config.get("wet", 0)
+        samples = config.get("samples", 8)
+        skip_above = config.get("skip_above")
+        shorten_above = config.get("shorten_above")
+        if dry == wet or samples < 1:
+            return None
+        if skip_above is not None and shorten_above is not None and shorten_above >= skip_above:
+            return None
+        return Sensor(config["gpio"], dry, wet, skip_above, shorten_above, samples)
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return None
@@ -0,0 +1,114 @@
+import json
+import uasyncio as asyncio
+
+class Session:
+    """Output of a client session, collected in RAM while a command runs and then
+       written to the client stream with backpressure.
+
+       Output beyond max_output bytes per command is dropped, and a client that doesn't
+       take its output within write_timeout seconds raises asyncio.TimeoutError, so a
+       slow or dead client can't pin memory or hold up the event loop. The output is
+       handed to the stream chunk bytes at a time and drained in between, so a slow
+       client (e.g. a 9600 baud UART) lets the other sessions and tasks run while it
+       catches up, and the stream never buffers more than about one chunk.
+
+       Long output is passed to stream() as a generator of strings instead, which is
+       only run as the client takes the output, so it is neither held in RAM nor
+       truncated."""
+    def __init__(self, writer, max_output=32768, write_timeout=10, name="tcp", chunk=512):
+        self.writer = writer
+        self.max_output = max_output
+        self.write_timeout = write_timeout
+        self.name = name
+        self.chunk = chunk
+        self.buf = []
+        self.size = 0
+        self.truncated = False
+        # Set when the session uses the json lines protocol
+        self.api = False
+        self.commands = 0
+        self.bytes_out = 0
+        self.pending = 0
+
+    def write(self, s):
+        if self.size + len(s) > self.max_output:
+            self.truncated = True
+            return
+        self.buf.append(s)
+        self.size += len(s)
+
+    def notice(self, text):
+        """Write a message of the session itself rather than of a command, as an error
+           response once the session uses the json lines protocol"""
+        if self.api:
+            self.write(json.dumps({"ok": False, "error": text}) + "\n")
+        else:
+            self.write(text + "\n")
+
+    def stream(self, lines):
+        """Queue the output of a generator of strings, written out by the next flush"""
+        self.buf.append(lines)
+
+    async def flush(self):
+        """Write out the buffered output and wait until the client has taken it"""
+        if self.truncated:
+            self.truncated = False
+            self.size = 0
+            self.notice("Output truncated to {} bytes".format(self.max_output))
+        buf = self.buf
+        self.buf = []
+        self.size = 0
+        for item in buf:
+            if isinstance(item, str):
+                await self.send(item)
+            else:
+                await self.send_lines(item)
+        self.bytes_out += self.pending
+        self.pending = 0
+        # Draining always yields, so the next command of this session waits for its turn
+        await asyncio.wait_for(self.writer.drain(), self.write_timeout)
+
+    async def send_lines(self, lines):
+        """Write out the strings of a generator, ending the output with an error line if
+           the generator raises, so the session carries on with its next command"""
+        while(True):
+            try:
+                s = next(lines)
+            except StopIteration:
+                return
+            except Exception as e:
+                if self.api:
+                    await self.send(json.dumps({"ok": False, "error": "failed: {!r}".format(e)}) + "\n")
+                else:
+                    await self.send("Error: {!r}\n".format(e))
+                return
+            await self.send(s)
+
+    async def send(self, s):
+        """Write a string to the stream, draining after every chunk bytes"""
+        i = 0
+        while i < len(s):
+            # Long strings are cut so each drain has about one chunk to wait for
+            part = s if i == 0 and len(s) <= self.chunk else s[i:i + self.chunk]
+            self.writer.write(part)
+            i += len(part)
+            self.pending += len(part)
+            if self.pending >= self.chunk:
+                self.bytes_out += self.pending
+                self.pending = 0
+                await asyncio.wait_for(self.writer.drain(), self.write_timeout)
+
+    async def close(self):
+        try:
+            self.writer.close()
+            await asyncio.wait_for(self.writer.wait_closed(), self.write_timeout)
+        except (OSError, asyncio.TimeoutError):
+            pass
+
+def write_lines(writer, lines):
+    """Write the strings of a generator to a Session as a stream, or right away to other writers"""
+    if isinstance(writer, Session):
+        writer.stream(lines)
+    else:
+        for s in lines:
+            writer.write(s)
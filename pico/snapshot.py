@@ -0,0 +1,162 @@
+import os
+import json
+import struct
+import binascii
+from array import array
+from schedule import Schedule
+from sensor import Sensor
+from store import atomic_rename
+
+# Binary snapshot of a compiled configuration, so a boot doesn't have to parse the json
+# and the schedule strings. It is only used if the crc of the source files matches.
+# Header: magic, version, number of domains, crc of the source files, length of the settings
+HEADER_FMT = "<4sBxHII"
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+MAGIC = b"WCFG"
+VERSION = 2
+# Domain: name length, gpio, flags, duration, current, flow, watering times, every_days, start_day,
+# season start and end, followed by the name and the minutes of the week (the bytes of the
+# array, in the byte order of the board that wrote it)
+DOMAIN_FMT = "<BBBdddHHiHH"
+DOMAIN_SIZE = struct.calcsize(DOMAIN_FMT)
+# Sensor: gpio, samples, dry, wet, skip_above and shorten_above (-1 if not set)
+SENSOR_FMT = "<BBHHhh"
+SENSOR_SIZE = struct.calcsize(SENSOR_FMT)
+
+MISSED_RUN = 1
+HAS_SCHEDULE = 2
+HAS_SENSOR = 4
+HAS_SEASON = 8
+INT_DURATION = 16
+INT_CURRENT = 32
+INT_FLOW = 64
+
+def source_crc(filenames):
+    """crc32 of the contents of the files (missing files are skipped), read in small chunks"""
+    crc = 0
+    buf = bytearray(256)
+    mv = memoryview(buf)
+    for filename in filenames:
+        try:
+            with open(filename, "rb") as f:
+                while(True):
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    crc = binascii.crc32(mv[:n], crc)
+        except OSError:
+            pass
+    return crc
+
+def pack_domain(d):
+    """Return the bytes of a Domain"""
+    flags = 0
+    if d.missed == "run":
+        flags |= MISSED_RUN
+    if isinstance(d.duration, int):
+        flags |= INT_DURATION
+    if isinstance(d.current, int):
+        flags |= INT_CURRENT
+    if isinstance(d.flow, int):
+        flags |= INT_FLOW
+    (n, every_days, start_day, season) = (0, 0, 0, (0, 0))
+    if d.schd:
+        flags |= HAS_SCHEDULE
+        (n, every_days, start_day) = (d.schd.count, d.schd.every_days, d.schd.start_day)
+        if d.schd.season:
+            flags |= HAS_SEASON
+            season = d.schd.season
+    if d.sensor:
+        flags |= HAS_SENSOR
+    name = d.name.encode()
+    data = struct.pack(DOMAIN_FMT, len(name), d.gpio, flags, d.duration, d.current, d.flow, n, every_days, start_day, *season) + name
+    if d.schd:
+        data += bytes(d.schd.minutes)
+    if d.sensor:
+        s = d.sensor
+        data += struct.pack(SENSOR_FMT, s.gpio, len(s.buf), s.dry, s.wet,
+                            -1 if s.skip_above is None else s.skip_above,
+                            -1 if s.shorten_above is None else s.shorten_above)
+    return data
+
+def save(filename, crc, name, settings, domains):
+    """Write the snapshot of a configuration (a name, settings dictionary and Domains),
+       return the number of bytes written or 0 if it can't be represented"""
+    info = dict(settings)
+    info["name"] = name
+    info = json.dumps(info).encode()
+    tmpname = filename + ".tmp"
+    size = HEADER_SIZE + len(info)
+    try:
+        with open(tmpname, "wb") as f:
+            f.write(struct.pack(HEADER_FMT, MAGIC, VERSION, len(domains), crc, len(info)))
+            f.write(info)
+            for d in domains:
+                data = pack_domain(d)
+                f.write(data)
+                size += len(data)
+    except Exception:
+        # A value that doesn't fit its field (e.g. a gpio above 255) or a full filesystem,
+        # the configuration is then loaded from the json file
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+        return 0
+    atomic_rename(tmpname, filename)
+    return size
+
+def load(filename, crc, make_domain):
+    """Read a snapshot with one read and return (name, settings, dictionary of domains), with
+       the domains created by make_domain(name, gpio, duration). Return None if the snapshot
+       is missing, damaged or was made from other source files."""
+    try:
+        buf = bytearray(os.stat(filename)[6])
+        with open(filename, "rb") as f:
+            n = f.readinto(buf)
+    except OSError:
+        return None
+    try:
+        (magic, version, count, file_crc, info_size) = struct.unpack_from(HEADER_FMT, buf)
+        if n != len(buf) or magic != MAGIC or version != VERSION or file_crc != crc:
+            return None
+        mv = memoryview(buf)
+        pos = HEADER_SIZE + info_size
+        settings = json.loads(bytes(mv[HEADER_SIZE:pos]))
+        name = settings.pop("name")
+        domains = dict()
+        for i in range(count):
+            (name_size, gpio, flags, duration, current, flow, n, every_days, start_day, start, end) = struct.unpack_from(DOMAIN_FMT, buf, pos)
+            pos += DOMAIN_SIZE
+            dname = bytes(mv[pos:pos + name_size]).decode()
+            pos += name_size
+            if flags & INT_DURATION:
+                duration = int(duration)
+            if flags & INT_CURRENT:
+                current = int(current)
+            if flags & INT_FLOW:
+                flow = int(flow)
+            schd = None
+            if flags & HAS_SCHEDULE:
+                schd = Schedule()
+                schd.minutes = array("H", bytes(mv[pos:pos + 2 * n]))
+                pos += 2 * n
+                schd.every_days = every_days
+                schd.start_day = start_day
+                if flags & HAS_SEASON:
+                    schd.season = (start, end)
+            sensor = None
+            if flags & HAS_SENSOR:
+                (sgpio, samples, dry, wet, skip_above, shorten_above) = struct.unpack_from(SENSOR_FMT, buf, pos)
+                pos += SENSOR_SIZE
+                sensor = Sensor(sgpio, dry, wet, None if skip_above < 0 else skip_above,
+                                None if shorten_above < 0 else shorten_above, samples)
+            d = make_domain(dname, gpio, duration)
+            d.configure(duration, (schd, "run" if flags & MISSED_RUN else "skip", sensor, current, flow))
+            domains[dname] = d
+        if pos != len(buf):
+            return None
+    except Exception:
+        # Truncated or garbled contents
+        return None
+    return (name, settings, domains)
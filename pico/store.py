@@ -0,0 +1,135 @@
+import time
+import json
+import os
+import uasyncio as asyncio
+
+def atomic_write(filename, data):
+    """Write data to a temporary file and rename it over filename, so a power cut
+       leaves either the old or the new contents. Return the number of bytes written."""
+    tmpname = filename + ".tmp"
+    with open(tmpname, "w") as f:
+        f.write(data)
+    atomic_rename(tmpname, filename)
+    return len(data)
+
+def atomic_rename(tmpname, filename):
+    """Rename a fully written temporary file over filename"""
+    try:
+        os.rename(tmpname, filename)
+    except OSError:
+        # Some filesystems can't rename over an existing file
+        os.remove(filename)
+        os.rename(tmpname, filename)
+
+class Store:
+    """Runtime state (clock checkpoint, last watering of each domain, counters) kept as
+       key/value pairs that survive a reboot.
+
+       Changes are collected in RAM and appended to a journal as one json line per flush.
+       A flush happens every flush_interval seconds, as soon as flush_dirty keys have
+       changed or right away for urgent changes. Once the journal grows past compact_size
+       bytes (and the size of the snapshot) it is folded into the snapshot file, which is
+       replaced atomically."""
+    def __init__(self, snapshot="state.json", journal="state.log"):
+        self.snapshot = snapshot
+        self.journal = journal
+        self.flush_interval = 300
+        self.flush_dirty = 20
+        self.compact_size = 4096
+        self.state = dict()
+        self.dirty = dict()
+        self.journal_size = 0
+        self.snapshot_size = 0
+        self.bytes_written = 0
+        self.flushes = 0
+        self.uptime = 0
+        # Functions called on every flush, to checkpoint other state at the same time
+        self.hooks = []
+        self.wake = asyncio.Event()
+        self.load()
+
+    def set_policy(self, flush_interval=300, flush_dirty=20, compact_size=4096):
+        self.flush_interval = flush_interval
+        self.flush_dirty = flush_dirty
+        self.compact_size = compact_size
+
+    def load(self):
+        """Read the snapshot then replay the journal on top of it, skipping incomplete lines.
+           A journal with an incomplete line is compacted right away."""
+        try:
+            with open(self.snapshot, "r") as f:
+                self.state = json.load(f)
+                self.snapshot_size = f.tell()
+        except (OSError, ValueError):
+            self.state = dict()
+        torn = False
+        try:
+            with open(self.journal, "r") as f:
+                for line in f:
+                    self.journal_size += len(line)
+                    try:
+                        self.state.update(json.loads(line))
+                    except ValueError:
+                        # Incomplete line from a power cut during a flush
+                        torn = True
+        except OSError:
+            pass
+        if torn:
+            # The next flush would be appended to the incomplete line, so start afresh
+            self.compact()
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def set(self, key, value, urgent=False):
+        """Change a key, it is written on the next flush"""
+        if self.state.get(key) == value and key not in self.dirty:
+            return
+        self.state[key] = value
+        self.dirty[key] = value
+        if urgent or len(self.dirty) >= self.flush_dirty:
+            self.wake.set()
+
+    def flush(self):
+        """Append the changed keys to the journal, compacting it if it got too big"""
+        for hook in self.hooks:
+            hook()
+        if not self.dirty:
+            return
+        line = json.dumps(self.dirty) + "\n"
+        with open(self.journal, "a") as f:
+            f.write(line)
+        self.dirty = dict()
+        self.journal_size += len(line)
+        self.bytes_written += len(line)
+        self.flushes += 1
+        # Compacting rewrites the whole snapshot, so let the journal grow at least as big
+        if self.journal_size > self.compact_size and self.journal_size > self.snapshot_size:
+            self.compact()
+
+    def compact(self):
+        """Replace the snapshot with the current state and empty the journal"""
+        self.snapshot_size = atomic_write(self.snapshot, json.dumps(self.state))
+        self.bytes_written += self.snapshot_size
+        with open(self.journal, "w") as f:
+            pass
+        self.journal_size = 0
+
+    def bytes_per_hour(self):
+        return int(self.bytes_written * 3600 // max(self.uptime, 1))
+
+    async def run(self):
+        last = time.ticks_ms()
+        while(True):
+            self.wake.clear()
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.flush_interval)
+                # Give changes made at about the same time a chance to go in the same flush
+                await asyncio.sleep(1)
+            except asyncio.TimeoutError:
+                pass
+            self.flush()
+            # Count the time the store has been running with ticks, as the clock can be changed
+            now = time.ticks_ms()
+            self.uptime += time.ticks_diff(now, last) / 1000
+            last = now
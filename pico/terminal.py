@@ -0,0 +1,69 @@
+import uasyncio as asyncio
+
+CR = 13
+LF = 10
+BS = 8
+DEL = 127
+
+class Terminal:
+    """Line input from a stream such as a UART, woken by the event loop as soon as
+       characters arrive instead of polling.
+
+       Characters are read in chunks into a preallocated buffer and collected in a
+       preallocated line buffer, with optional echo and backspace editing, so no memory
+       is allocated per keystroke. The echo goes to out, or back to the stream if None
+       (e.g. USB reads sys.stdin and echoes to sys.stdout). A stream whose reads only
+       return once the buffer is full, like sys.stdin, must be read with chunk=1."""
+    def __init__(self, stream, echo=True, maxlen=1024, out=None, chunk=64):
+        self.stream = stream
+        self.out = stream if out is None else out
+        self.reader = asyncio.StreamReader(stream)
+        self.echo = echo
+        self.line = bytearray(maxlen)
+        self.n = 0
+        self.chunk = bytearray(chunk)
+        self.pos = 0
+        self.end = 0
+        self.echo_buf = bytearray(3 * len(self.chunk))
+        self.last = 0
+
+    async def readline(self):
+        """Return the next line, without the line ending, as a string"""
+        while(True):
+            if self.pos >= self.end:
+                self.end = await self.reader.readinto(self.chunk)
+                self.pos = 0
+                if not self.end:
+                    continue
+            k = 0
+            done = False
+            while self.pos < self.end and not done:
+                c = self.chunk[self.pos]
+                self.pos += 1
+                if c == CR or c == LF:
+                    # Don't treat the LF of a CR LF as an empty line
+                    if not (c == LF and self.last == CR):
+                        done = True
+                        self.echo_buf[k] = CR
+                        self.echo_buf[k + 1] = LF
+                        k += 2
+                elif c == BS or c == DEL:
+                    if self.n > 0:
+                        self.n -= 1
+                        self.echo_buf[k] = BS
+                        self.echo_buf[k + 1] = 32
+                        self.echo_buf[k + 2] = BS
+                        k += 3
+                elif c >= 32 and self.n < len(self.line):
+                    self.line[self.n] = c
+                    self.n += 1
+                    self.echo_buf[k] = c
+                    k += 1
+                self.last = c
+            if self.echo and k:
+                self.out.write(memoryview(self.echo_buf)[:k])
+            if done:
+                # Empty the line buffer first, so a line that can't be decoded doesn't stay in it
+                n = self.n
+                self.n = 0
+                return self.line[:n].decode()
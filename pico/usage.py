@@ -0,0 +1,154 @@
+import struct
+from array import array
+from names import Names
+from log import get_logger
+
+log = get_logger("usage")
+
+# Waterings of each domain are summed per day over the last DAYS days, and per week
+# (starting on Monday) over the last WEEKS weeks
+DAYS = 14
+WEEKS = 13
+BUCKETS = DAYS + WEEKS
+
+# File layout: a header followed by one record per domain, rewritten in place when the
+# domain waters. Header: magic, DAYS, WEEKS, number of records
+HEADER_FMT = "<4sHHH"
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+MAGIC = b"WUS3"
+# Record: domain id (see names.py), then the bucket array (in the byte order of the board)
+ID_FMT = "<I"
+ID_SIZE = struct.calcsize(ID_FMT)
+RECORD_SIZE = ID_SIZE + 8 * BUCKETS
+
+def week_number(day):
+    """Number of the week (Monday to Sunday) of a day number, see schedule.day_number"""
+    return (day + 5) // 7
+
+class DomainUsage:
+    """Rolling usage totals of one domain in a fixed array of day and week buckets.
+
+       Each bucket is two words: (day or week number + 1) << 16 | runs, and tenths of
+       seconds watered. A bucket holding an older period is reset when it is reused, so
+       recording a watering is two bucket updates and nothing ever has to be rotated."""
+    __slots__ = ("buckets", "slot", "dirty")
+
+    def __init__(self, slot=None):
+        self.buckets = array("I", bytes(8 * BUCKETS))
+        # Index of the record in the usage file, None until first written
+        self.slot = slot
+        self.dirty = False
+
+    def add(self, i, period, tenths):
+        b = self.buckets
+        if b[2 * i] >> 16 != period + 1:
+            b[2 * i] = (period + 1) << 16
+            b[2 * i + 1] = 0
+        b[2 * i] += 1
+        b[2 * i + 1] += tenths
+
+    def record(self, day, duration):
+        """Count a watering of duration seconds on a day number"""
+        tenths = int(duration * 10)
+        self.add(day % DAYS, day, tenths)
+        week = week_number(day)
+        self.add(DAYS + week % WEEKS, week, tenths)
+        self.dirty = True
+
+    def total(self, today, days):
+        """Return (runs, seconds) over the last days days up to today. Beyond DAYS days
+           whole weeks are counted, up to WEEKS weeks."""
+        if days <= DAYS:
+            (first, n, last) = (0, DAYS, today)
+            start = today - days + 1
+        else:
+            (first, n, last) = (DAYS, WEEKS, week_number(today))
+            start = last - (days + 6) // 7 + 1
+        b = self.buckets
+        runs = 0
+        tenths = 0
+        for i in range(first, first + n):
+            period = (b[2 * i] >> 16) - 1
+            if start <= period <= last:
+                runs += b[2 * i] & 0xffff
+                tenths += b[2 * i + 1]
+        return (runs, tenths / 10)
+
+class Usage:
+    """Usage totals of all domains, checkpointed to a file of fixed size records.
+
+       Records are found by the id of the domain name in names, and only read when their
+       domain is configured. checkpoint() writes the records of the domains that watered
+       since the last one in place, so it costs one record per domain that changed. Records of removed domains
+       stay in the file, and come back if the domain is added again."""
+    def __init__(self, filename="usage.bin", names=None):
+        self.filename = filename
+        self.names = Names() if names is None else names
+        self.slots = dict()
+        self.domains = dict()
+        self.count = 0
+        self.bytes_written = 0
+        self.buf = bytearray(max(HEADER_SIZE, RECORD_SIZE))
+        try:
+            with open(filename, "rb") as f:
+                n = f.readinto(self.buf)
+                if n < HEADER_SIZE or struct.unpack_from(HEADER_FMT, self.buf)[:3] != (MAGIC, DAYS, WEEKS):
+                    log.warning("Usage file {} has a different layout, starting new totals", filename)
+                    return
+                self.count = struct.unpack_from(HEADER_FMT, self.buf)[3]
+                for slot in range(self.count):
+                    f.seek(HEADER_SIZE + slot * RECORD_SIZE)
+                    if f.readinto(memoryview(self.buf)[:ID_SIZE]) < ID_SIZE:
+                        self.count = slot
+                        break
+                    self.slots[struct.unpack_from(ID_FMT, self.buf)[0]] = slot
+        except OSError:
+            pass
+
+    def get(self, name):
+        """Return the DomainUsage of a domain, restored from the file if it has a record"""
+        usage = self.domains.get(name)
+        if usage is not None:
+            return usage
+        did = self.names.get(name)
+        slot = None if did is None else self.slots.get(did)
+        usage = DomainUsage(slot)
+        if slot is not None:
+            try:
+                with open(self.filename, "rb") as f:
+                    f.seek(HEADER_SIZE + slot * RECORD_SIZE + ID_SIZE)
+                    f.readinto(usage.buckets)
+            except OSError:
+                pass
+        self.domains[name] = usage
+        return usage
+
+    def checkpoint(self):
+        """Write the records of the domains that changed"""
+        dirty = [(name, u) for (name, u) in self.domains.items() if u.dirty]
+        if not dirty:
+            return
+        try:
+            f = open(self.filename, "r+b")
+        except OSError:
+            f = open(self.filename, "w+b")
+            self.count = 0
+            self.slots = dict()
+            for u in self.domains.values():
+                u.slot = None
+        with f:
+            for (name, u) in dirty:
+                did = self.names.id(name)
+                if u.slot is None:
+                    u.slot = self.count
+                    self.slots[did] = u.slot
+                    self.count += 1
+                struct.pack_into(ID_FMT, self.buf, 0, did)
+                f.seek(HEADER_SIZE + u.slot * RECORD_SIZE)
+                f.write(memoryview(self.buf)[:ID_SIZE])
+                f.write(u.buckets)
+                u.dirty = False
+            struct.pack_into(HEADER_FMT, self.buf, 0, MAGIC, DAYS, WEEKS, self.count)
+            f.seek(0)
+            f.write(memoryview(self.buf)[:HEADER_SIZE])
+        self.bytes_written += len(dirty) * RECORD_SIZE + HEADER_SIZE
@@ -0,0 +1,110 @@
+"""
+Run stand-in devices on localhost for testing host tools such as tools/fleet.py.
+
+Each device runs the code in pico/ in its own process and working directory,
+with serve_client on its port and the json lines API on the port above it, and
+a clock that starts at --start and then follows real time.
+
+    python sim/device.py --count 4 --port 41415 --inventory /tmp/devices.json
+    python tools/fleet.py /tmp/devices.json status
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+
+import hal
+from simulate import random_config
+
+
+async def serve(device, port):
+    uasyncio = sys.modules["uasyncio"]
+    asyncio.create_task(hal.follow_real_time())
+    asyncio.create_task(device.scheduler.run())
+    asyncio.create_task(device.ws.store.run())
+    await uasyncio.start_server(device.serve_client, "127.0.0.1", port)
+    await uasyncio.start_server(device.serve_api, "127.0.0.1", port + 1)
+    print("Device listening on port {}".format(port), flush=True)
+    await asyncio.Event().wait()
+
+
+def run_device(args):
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+    else:
+        config = random_config(args.domains, random.Random(args.port))
+        config["name"] = "Stand-in {}".format(args.port)
+    start = datetime.datetime.strptime(args.start, "%Y-%m-%d %H:%M")
+    workdir = tempfile.mkdtemp(prefix="watering-device-")
+    try:
+        shutil.copy(os.path.join(hal.PICO_DIR, "banner.txt"), workdir)
+        with open(os.path.join(workdir, "config.json"), "w") as f:
+            json.dump(config, f)
+        os.chdir(workdir)
+        hal.set_localtime(start.year, start.month, start.day, start.hour, start.minute)
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+            device = hal.load("main")
+            device.boot()
+        loop = hal.new_loop(virtual=False)
+        loop.run_until_complete(serve(device, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=41415, help="port of the first device")
+    parser.add_argument("--count", type=int, default=1, help="number of devices, on every second port")
+    parser.add_argument("--config", help="configuration file of the devices (default: random schedules)")
+    parser.add_argument("--domains", type=int, default=3, help="number of random domains")
+    parser.add_argument("--start", default="2000-01-01 00:00", help="initial device time YYYY-MM-DD HH:MM")
+    parser.add_argument("--inventory", help="write an inventory of the devices for tools/fleet.py")
+    parser.add_argument("--verbose", action="store_true", help="show the device console output")
+    args = parser.parse_args()
+
+    ports = [args.port + 2 * i for i in range(args.count)]
+    if args.inventory:
+        with open(args.inventory, "w") as f:
+            json.dump([{"name": "device{}".format(i), "host": "127.0.0.1", "port": p} for (i, p) in enumerate(ports)], f, indent=1)
+    if args.count == 1:
+        run_device(args)
+        return 0
+
+    # One process per device since the device code keeps its state in module globals
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "--port", str(p), "--count", "1"] + device_args(args)) for p in ports]
+    try:
+        for p in procs:
+            p.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in procs:
+            p.terminate()
+    return 0
+
+
+def device_args(args):
+    """Command line options passed on to each device process"""
+    argv = ["--domains", str(args.domains), "--start", args.start]
+    if args.config:
+        argv += ["--config", os.path.abspath(args.config)]
+    if args.verbose:
+        argv.append("--verbose")
+    return argv
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,484 @@
+"""
+Hardware abstraction layer for running the Pico code under CPython.
+
+Installs fake machine, network and uasyncio modules and a virtual clock so
+that the modules in pico/ can be imported and run on a Linux box.  Time only
+moves when the event loop is idle (or when blocking code calls time.sleep),
+so a week of schedules runs in seconds.
+"""
+import asyncio
+import calendar
+import importlib
+import os
+import selectors
+import sys
+import time as _time
+import types
+
+PICO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pico")
+
+# MicroPython counts seconds from 2000-01-01 rather than 1970-01-01
+EPOCH_OFFSET = 946684800
+
+
+class VirtualClock:
+    """Seconds since 2000-01-01, advanced explicitly"""
+    def __init__(self, start=0.0):
+        self.now = float(start)
+
+    def advance(self, secs):
+        if secs > 0:
+            self.now += secs
+
+    def set(self, secs):
+        self.now = float(secs)
+
+
+clock = VirtualClock()
+
+# Timelines recorded by the fake peripherals
+pin_log = []        # (time, pin id, value) for every change of an output pin
+pins = {}           # pin id -> Pin
+
+
+def localtime(secs=None):
+    if secs is None:
+        secs = clock.now
+    t = _time.gmtime(int(secs) + EPOCH_OFFSET)
+    return (t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, t.tm_wday, t.tm_yday)
+
+
+def mktime(t):
+    (year, month, mday, hour, minute, second) = t[:6]
+    return calendar.timegm((year, month, mday, hour, minute, second, 0, 0, 0)) - EPOCH_OFFSET
+
+
+def set_localtime(year, month, mday, hour=0, minute=0, second=0):
+    clock.set(mktime((year, month, mday, hour, minute, second)))
+
+
+class _FakeModule(types.ModuleType):
+    """Module that falls back to a real CPython module for missing attributes"""
+    def __init__(self, name, fallback):
+        super().__init__(name)
+        self._fallback = fallback
+
+    def __getattr__(self, attr):
+        return getattr(self._fallback, attr)
+
+
+def _make_time():
+    m = _FakeModule("time", _time)
+    m.time = lambda: int(clock.now)
+    m.time_ns = lambda: int(clock.now * 1000000000)
+    m.localtime = localtime
+    m.gmtime = localtime
+    m.mktime = mktime
+    m.sleep = clock.advance
+    m.sleep_ms = lambda ms: clock.advance(ms / 1000)
+    m.sleep_us = lambda us: clock.advance(us / 1000000)
+    m.ticks_ms = lambda: int(clock.now * 1000) & 0x3fffffff
+    m.ticks_us = lambda: int(clock.now * 1000000) & 0x3fffffff
+    m.ticks_cpu = m.ticks_us
+    m.ticks_add = lambda ticks, delta: (ticks + delta) & 0x3fffffff
+    m.ticks_diff = lambda a, b: ((a - b + 0x20000000) & 0x3fffffff) - 0x20000000
+    return m
+
+
+def _ilistdir(path="."):
+    for entry in os.scandir(path):
+        st = entry.stat()
+        yield (entry.name, 0x4000 if entry.is_dir() else 0x8000, st.st_ino, st.st_size)
+
+
+def _make_os():
+    m = _FakeModule("os", os)
+    m.ilistdir = _ilistdir
+    return m
+
+
+def _make_gc():
+    import gc as _gc
+    m = _FakeModule("gc", _gc)
+    m.mem_free = lambda: 200 * 1024
+    m.mem_alloc = lambda: 0
+    m.threshold = lambda *args: -1
+    return m
+
+
+# --- machine ---------------------------------------------------------------
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_RISING = 4
+    IRQ_FALLING = 8
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.mode = mode
+        self._value = 0
+        pins[id] = self
+        if value is not None:
+            self.value(value)
+
+    def init(self, mode=-1, pull=-1, value=None):
+        if value is not None:
+            self.value(value)
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        v = 1 if v else 0
+        if v != self._value:
+            self._value = v
+            pin_log.append((clock.now, self.id, v))
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def toggle(self):
+        self.value(not self._value)
+
+    def irq(self, handler=None, trigger=None):
+        pass
+
+
+class RTC:
+    def datetime(self, t=None):
+        if t is None:
+            (year, month, mday, hour, minute, second, wday, yday) = localtime()
+            return (year, month, mday, wday, hour, minute, second, 0)
+        (year, month, mday, wday, hour, minute, second) = (tuple(t) + (0, 0, 0))[:7]
+        set_localtime(year, month, mday, hour, minute, second)
+
+
+class UART:
+    """UART whose receive side is fed by feed() and whose output is collected in tx"""
+    def __init__(self, id, baudrate=9600, tx=None, rx=None, **kwargs):
+        self.id = id
+        self.baudrate = baudrate
+        self.rx = bytearray()
+        self.tx = bytearray()
+
+    def init(self, baudrate=9600, **kwargs):
+        self.baudrate = baudrate
+
+    def feed(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.rx += data
+
+    def any(self):
+        return len(self.rx)
+
+    def read(self, n=None):
+        if not self.rx:
+            return None
+        if n is None:
+            n = len(self.rx)
+        data = bytes(self.rx[:n])
+        del self.rx[:n]
+        return data
+
+    def readinto(self, buf, n=None):
+        data = self.read(len(buf) if n is None else n)
+        if not data:
+            return None
+        buf[:len(data)] = data
+        return len(data)
+
+    def write(self, buf):
+        if isinstance(buf, str):
+            buf = buf.encode()
+        self.tx += buf
+        return len(buf)
+
+    def flush(self):
+        pass
+
+    def output(self):
+        data = self.tx.decode()
+        self.tx = bytearray()
+        return data
+
+
+class ADC:
+    """ADC whose reading is set with ADC.levels[pin id]"""
+    levels = {}
+
+    def __init__(self, pin):
+        self.id = pin.id if isinstance(pin, Pin) else pin
+
+    def read_u16(self):
+        return ADC.levels.get(self.id, 0)
+
+
+def _make_machine():
+    m = types.ModuleType("machine")
+    m.Pin = Pin
+    m.RTC = RTC
+    m.UART = UART
+    m.ADC = ADC
+    m.reset = lambda: None
+    m.freq = lambda *args: 125000000
+    return m
+
+
+# --- network ---------------------------------------------------------------
+
+class WLAN:
+    # Set to False to simulate an access point that is out of range
+    available = True
+
+    def __init__(self, interface=0):
+        self._active = False
+        self._status = 0
+
+    def active(self, a=None):
+        if a is None:
+            return self._active
+        self._active = a
+
+    def config(self, *args, **kwargs):
+        pass
+
+    def connect(self, ssid=None, password=None):
+        self._status = 3 if WLAN.available else -2
+
+    def disconnect(self):
+        self._status = 0
+
+    def status(self):
+        if self._status == 3 and not WLAN.available:
+            self._status = -1
+        return self._status
+
+    def isconnected(self):
+        return self.status() == 3
+
+    def ifconfig(self):
+        return ("192.168.0.100", "255.255.255.0", "192.168.0.1", "192.168.0.1")
+
+
+def _make_network():
+    m = types.ModuleType("network")
+    m.WLAN = WLAN
+    m.STA_IF = 0
+    m.AP_IF = 1
+    return m
+
+
+# --- uasyncio ---------------------------------------------------------------
+
+class _VirtualSelector:
+    """Selector that advances the virtual clock instead of waiting"""
+    def __init__(self):
+        self._sel = selectors.DefaultSelector()
+
+    def select(self, timeout=None):
+        events = self._sel.select(0)
+        if not events:
+            if timeout is None:
+                events = self._sel.select(0.01)
+            else:
+                clock.advance(timeout)
+        return events
+
+    def __getattr__(self, attr):
+        return getattr(self._sel, attr)
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        super().__init__(_VirtualSelector())
+        # Timestamps are large floats so the monotonic clock resolution would be lost
+        self._clock_resolution = 1e-6
+
+    def time(self):
+        return clock.now
+
+
+class _StreamWriter:
+    """Wrap a CPython StreamWriter so that it accepts str like the MicroPython one"""
+    def __init__(self, writer):
+        self._writer = writer
+
+    def write(self, buf):
+        if isinstance(buf, str):
+            buf = buf.encode()
+        self._writer.write(buf)
+
+    def __getattr__(self, attr):
+        return getattr(self._writer, attr)
+
+
+async def _start_server(cb, host, port, backlog=5):
+    async def client(reader, writer):
+        await cb(reader, _StreamWriter(writer))
+    return await asyncio.start_server(client, host, port, backlog=backlog)
+
+
+class StreamReader:
+    """Stand-in for a socket reader, readline() returns b"" once the data runs out like a closed socket"""
+    def __init__(self, data=b""):
+        self.data = bytearray()
+        self.feed(data)
+
+    def feed(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.data += data
+
+    async def readline(self):
+        await asyncio.sleep(0)
+        i = self.data.find(b"\n") + 1
+        if i == 0:
+            i = len(self.data)
+        line = bytes(self.data[:i])
+        del self.data[:i]
+        return line
+
+    async def read(self, n=-1):
+        await asyncio.sleep(0)
+        if n < 0:
+            n = len(self.data)
+        data = bytes(self.data[:n])
+        del self.data[:n]
+        return data
+
+
+class StreamWriter:
+    """Stand-in for a socket writer that collects the output"""
+    def __init__(self):
+        self.out = bytearray()
+        self.closed = False
+
+    def write(self, buf):
+        if isinstance(buf, str):
+            buf = buf.encode()
+        self.out += buf
+
+    async def drain(self):
+        await asyncio.sleep(0)
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        self.closed = True
+
+    def get_extra_info(self, name, default=None):
+        return ("127.0.0.1", 0) if name == "peername" else default
+
+    def output(self):
+        data = self.out.decode()
+        self.out = bytearray()
+        return data
+
+
+class Stream:
+    """uasyncio.StreamReader/StreamWriter over a fake peripheral such as UART, waking
+       within a millisecond of virtual time when data arrives"""
+    def __init__(self, s):
+        self.s = s
+
+    async def readinto(self, buf):
+        while not self.s.any():
+            await asyncio.sleep(0.001)
+        return self.s.readinto(buf)
+
+    async def read(self, n=-1):
+        while not self.s.any():
+            await asyncio.sleep(0.001)
+        return self.s.read(None if n < 0 else n)
+
+    async def readline(self):
+        line = b""
+        while not line.endswith(b"\n"):
+            line += await self.read(1)
+        return line
+
+    def write(self, buf):
+        self.s.write(buf)
+
+    async def drain(self):
+        await asyncio.sleep(0)
+
+
+def _make_uasyncio():
+    m = _FakeModule("uasyncio", asyncio)
+    m.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+    m.start_server = _start_server
+    m.StreamReader = Stream
+    m.StreamWriter = Stream
+    m.run = lambda coro: new_loop().run_until_complete(coro)
+    return m
+
+
+async def follow_real_time(interval=0.05):
+    """Advance the virtual clock along with real time, for device code run on a normal
+       event loop (e.g. stand-in devices serving real sockets)"""
+    last = _time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        now = _time.monotonic()
+        clock.advance(now - last)
+        last = now
+
+
+def new_loop(virtual=True):
+    """Create and install a new event loop driven by the virtual clock (or real time)"""
+    loop = VirtualEventLoop() if virtual else asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+# --- installation ------------------------------------------------------------
+
+# Modules that are swapped in only while device code is imported, since the
+# rest of CPython needs the real ones
+_device_overrides = {}
+
+
+def install():
+    """Register the fake modules and put pico/ on the import path"""
+    if "machine" in sys.modules:
+        return
+    sys.modules["machine"] = _make_machine()
+    sys.modules["network"] = _make_network()
+    sys.modules["uasyncio"] = _make_uasyncio()
+    _device_overrides["time"] = _make_time()
+    _device_overrides["os"] = _make_os()
+    _device_overrides["gc"] = _make_gc()
+    # Import the standard modules the device code uses while the real ones are in place
+    for name in ("array", "binascii", "hashlib", "heapq", "json", "re", "struct"):
+        importlib.import_module(name)
+    if PICO_DIR not in sys.path:
+        sys.path.insert(0, PICO_DIR)
+
+
+def load(name):
+    """Import a module from pico/ so that it sees the virtual time, os and gc modules"""
+    install()
+    if name in sys.modules:
+        return sys.modules[name]
+    saved = {k: sys.modules[k] for k in _device_overrides}
+    sys.modules.update(_device_overrides)
+    try:
+        return importlib.import_module(name)
+    finally:
+        sys.modules.update(saved)
+
+
+def reset():
+    """Clear the recorded timelines and restart the clock"""
+    del pin_log[:]
+    pins.clear()
+    clock.set(0)
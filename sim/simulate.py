@@ -0,0 +1,238 @@
+"""
+Run the watering system on a virtual clock and check the pump timelines.
+
+Generates random schedules for many domains (or uses a config file), runs the
+device scheduler for a number of days of virtual time, and compares every pump
+pin on/off against the waterings the schedules call for.  Missed, doubled,
+unexpected and wrongly timed waterings are reported and make the exit status 1.
+
+    python sim/simulate.py --domains 300 --days 7
+    python sim/simulate.py --config pico/config.json --start 2024-01-01
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import hal
+
+EPOCH = datetime.datetime(2000, 1, 1)
+WEEKDAYS = ["MON", "TUE", "WED", "THU", "FRI", "SAT", "SUN"]
+
+
+def random_config(ndomains, rng):
+    """Configuration with ndomains domains using a mix of schedule rules"""
+    domains = []
+    for i in range(ndomains):
+        name = "domain{}".format(i)
+        entries = []
+        for k in range(rng.randint(1, 3)):
+            weekday = rng.choice(["*", rng.choice(WEEKDAYS), rng.sample(WEEKDAYS, rng.randint(2, 5))])
+            if rng.random() < 0.3:
+                start = rng.randint(0, 10 * 60)
+                entries.append({"weekday": weekday,
+                                "every": "{:02}:{:02}".format(*divmod(rng.choice([30, 60, 120, 180]), 60)),
+                                "from": "{:02}:{:02}".format(*divmod(start, 60)),
+                                "to": "{:02}:{:02}".format(*divmod(start + rng.randint(60, 600), 60))})
+            else:
+                times = sorted(set(rng.randint(0, 1439) for j in range(rng.randint(1, 4))))
+                entries.append({"weekday": weekday, "times": ["{:02}:{:02}".format(*divmod(t, 60)) for t in times]})
+        d = {"name": name, "gpio": i, "duration": rng.randint(1, 20), "schedule": entries}
+        if rng.random() < 0.1:
+            d["every_days"] = rng.randint(2, 4)
+        if rng.random() < 0.1:
+            d["season"] = rng.choice([["01-01", "06-30"], ["07-01", "12-31"], ["11-01", "02-28"]])
+        domains.append(d)
+    # No limit on the pumps running at once unless --max-pumps is given
+    return {"name": "Simulation", "pumps": {"max_running": None}, "domains": domains}
+
+
+def _minutes(t):
+    (h, m) = t.split(":")
+    return int(h) * 60 + int(m)
+
+
+def expected_waterings(config, start, days):
+    """Absolute minutes (since 2000-01-01) each domain should start watering, worked out
+       directly from the configuration rather than with the device schedule code"""
+    expected = {}
+    for d in config["domains"]:
+        starts = []
+        for day in range(days):
+            date = start.date() + datetime.timedelta(days=day)
+            if "every_days" in d:
+                anchor = datetime.date(2000, 1, 1)
+                if "start_date" in d:
+                    anchor = datetime.date(*[int(s) for s in d["start_date"].split("-")])
+                if (date - anchor).days % d["every_days"]:
+                    continue
+            if "season" in d:
+                (a, b) = [tuple(int(s) for s in md.split("-")) for md in d["season"]]
+                md = (date.month, date.day)
+                if (a <= b and not a <= md <= b) or (a > b and b < md < a):
+                    continue
+            minutes = set()
+            for entry in d.get("schedule", []):
+                weekday = entry["weekday"]
+                if weekday != "*" and WEEKDAYS[date.weekday()] not in ([weekday] if isinstance(weekday, str) else weekday):
+                    continue
+                if "every" in entry:
+                    minutes.update(range(_minutes(entry.get("from", "00:00")), _minutes(entry.get("to", "23:59")) + 1, _minutes(entry["every"])))
+                else:
+                    minutes.update(_minutes(t) for t in entry["times"])
+            day_start = int((datetime.datetime.combine(date, datetime.time()) - EPOCH).total_seconds()) // 60
+            starts.extend(day_start + m for m in sorted(minutes))
+        expected[d["name"]] = starts
+    return expected
+
+
+def pump_runs(config):
+    """(start, end) of every pump run from the recorded pin timeline, by domain name"""
+    gpio2name = {d["gpio"]: d["name"] for d in config["domains"]}
+    runs = {d["name"]: [] for d in config["domains"]}
+    on = {}
+    for (t, pin, value) in hal.pin_log:
+        if pin not in gpio2name:
+            continue
+        if value:
+            on[pin] = t
+        elif pin in on:
+            runs[gpio2name[pin]].append((on.pop(pin), t))
+    for (pin, t) in on.items():
+        runs[gpio2name[pin]].append((t, None))
+    return runs
+
+
+def check(config, expected, runs):
+    """Compare the pump runs with the expected waterings, return a list of problems"""
+    problems = []
+    durations = {d["name"]: d["duration"] for d in config["domains"]}
+    for (name, starts) in expected.items():
+        started = {}
+        for (t_on, t_off) in runs[name]:
+            minute = int(t_on) // 60
+            started[minute] = started.get(minute, 0) + 1
+            if t_off is None:
+                problems.append("{}: pump left on at {}".format(name, hal.localtime(t_on)[:6]))
+            elif abs((t_off - t_on) - durations[name]) > 0.01:
+                problems.append("{}: watered {:.2f} s instead of {} s at {}".format(name, t_off - t_on, durations[name], hal.localtime(t_on)[:6]))
+        for minute in starts:
+            n = started.pop(minute, 0)
+            if n == 0:
+                problems.append("{}: missed watering at {}".format(name, hal.localtime(minute * 60)[:6]))
+            elif n > 1:
+                problems.append("{}: watered {} times at {}".format(name, n, hal.localtime(minute * 60)[:6]))
+        for minute in sorted(started):
+            problems.append("{}: unexpected watering at {}".format(name, hal.localtime(minute * 60)[:6]))
+    return problems
+
+
+def check_queued(config, expected, runs, max_pumps):
+    """Checks for waterings that wait for a free pump, so they don't start on their
+       minute: durations, pumps left on and the number of pumps running at once"""
+    problems = []
+    durations = {d["name"]: d["duration"] for d in config["domains"]}
+    changes = []
+    for (name, domain_runs) in runs.items():
+        for (t_on, t_off) in domain_runs:
+            if t_off is None:
+                problems.append("{}: pump left on at {}".format(name, hal.localtime(t_on)[:6]))
+                continue
+            if abs((t_off - t_on) - durations[name]) > 0.01:
+                problems.append("{}: watered {:.2f} s instead of {} s at {}".format(name, t_off - t_on, durations[name], hal.localtime(t_on)[:6]))
+            changes += [(t_on, 1), (t_off, -1)]
+        if len(domain_runs) > len(expected[name]):
+            problems.append("{}: {} pump runs for {} scheduled waterings".format(name, len(domain_runs), len(expected[name])))
+    running = 0
+    for (t, change) in sorted(changes, key=lambda c: (c[0], c[1])):
+        running += change
+        if running > max_pumps:
+            problems.append("{} pumps running at {}".format(running, hal.localtime(t)[:6]))
+            break
+    return problems
+
+
+async def run_device(main, seconds, commands):
+    """Run the scheduler for the given virtual time, then a client session"""
+    asyncio.create_task(main.scheduler.run())
+    asyncio.create_task(main.ws.store.run())
+    await asyncio.sleep(seconds)
+    # Let the last waterings finish
+    await asyncio.sleep(max([d.duration for d in main.ws.domains.values()] + [0]) + 1)
+    reader = hal.StreamReader(commands.replace(";", "\n") + "\nquit\n")
+    writer = hal.StreamWriter()
+    await main.serve_client(reader, writer)
+    return writer.output()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--config", help="configuration file to simulate (default: random schedules)")
+    parser.add_argument("--domains", type=int, default=100, help="number of random domains")
+    parser.add_argument("--days", type=int, default=7, help="days of virtual time to run")
+    parser.add_argument("--start", default="2024-01-01", help="start date YYYY-MM-DD")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the generated schedules")
+    parser.add_argument("--session", default="info", help="commands to send through serve_client at the end")
+    parser.add_argument("--max-pumps", type=int, help="limit the pumps running at once (waterings then queue)")
+    parser.add_argument("--verbose", action="store_true", help="show the device console output")
+    args = parser.parse_args()
+
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+    else:
+        config = random_config(args.domains, random.Random(args.seed))
+    if args.max_pumps:
+        config["pumps"] = {"max_running": args.max_pumps}
+    start = datetime.datetime.strptime(args.start, "%Y-%m-%d")
+
+    workdir = tempfile.mkdtemp(prefix="watering-sim-")
+    cwd = os.getcwd()
+    console = io.StringIO()
+    real_start = time.time()
+    try:
+        shutil.copy(os.path.join(hal.PICO_DIR, "banner.txt"), workdir)
+        with open(os.path.join(workdir, "config.json"), "w") as f:
+            json.dump(config, f)
+        os.chdir(workdir)
+        hal.reset()
+        hal.set_localtime(start.year, start.month, start.day)
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else console):
+            device = hal.load("main")
+            device.boot()
+            loop = hal.new_loop()
+            session = loop.run_until_complete(run_device(device, args.days * 86400, args.session))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+    elapsed = time.time() - real_start
+
+    expected = expected_waterings(config, start, args.days)
+    runs = pump_runs(config)
+    if args.max_pumps:
+        problems = check_queued(config, expected, runs, args.max_pumps)
+    else:
+        problems = check(config, expected, runs)
+
+    print(session)
+    print("Simulated {} domains for {} days in {:.1f} s: {} waterings expected, {} pump runs".format(
+        len(config["domains"]), args.days, elapsed, sum(len(s) for s in expected.values()), sum(len(r) for r in runs.values())))
+    for p in problems:
+        print(p)
+    if problems:
+        print("{} problems found".format(len(problems)))
+        return 1
+    print("No missed or doubled waterings")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+"""
+Fixtures running the code in pico/ on the simulator's fake modules (see sim/hal.py),
+in a scratch directory with a virtual clock.
+"""
+import asyncio
+import json
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sim"))
+import hal
+
+CONFIG = {
+    "name": "Test",
+    "domains": [
+        {"name": "herbs", "gpio": 0, "duration": 20,
+         "schedule": [{"weekday": "*", "every": "00:30", "from": "06:00", "to": "20:00"}]},
+        {"name": "bonsai", "gpio": 1, "duration": 5, "every_days": 2, "schedule": []},
+    ],
+}
+
+
+def close_loop(loop):
+    """Cancel the tasks still running (e.g. waterings and sessions), so they don't write
+       to the next test's directory, and close the loop"""
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+
+
+@pytest.fixture
+def loop():
+    """Event loop on the virtual clock"""
+    loop = hal.new_loop()
+    yield loop
+    close_loop(loop)
+
+
+@pytest.fixture
+def real_loop():
+    """Event loop on real time, for code using real sockets"""
+    loop = hal.new_loop(virtual=False)
+    yield loop
+    close_loop(loop)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Empty working directory holding config.json and the banner"""
+    shutil.copy(os.path.join(hal.PICO_DIR, "banner.txt"), str(tmp_path))
+    with open(str(tmp_path / "config.json"), "w") as f:
+        json.dump(CONFIG, f)
+    monkeypatch.chdir(tmp_path)
+    hal.reset()
+    hal.set_localtime(2024, 1, 1, 12, 0)
+    return tmp_path
+
+
+@pytest.fixture
+def device(workdir):
+    """main.py booted on CONFIG"""
+    main = hal.load("main")
+    main.boot()
+    return main
+
+
+@pytest.fixture
+def large_device(workdir):
+    """main.py booted on 300 domains, whose info is several times max_output"""
+    config = {"name": "Large", "domains": [{"name": "domain-{:03}".format(i), "gpio": i, "duration": 10,
+                                            "schedule": [{"weekday": "*", "times": ["06:00", "18:00"]}]}
+                                           for i in range(300)]}
+    with open("config.json", "w") as f:
+        json.dump(config, f)
+    main = hal.load("main")
+    main.boot()
+    return main
+
+
+async def command(main, line):
+    """Output of a command line run through a session"""
+    writer = hal.StreamWriter()
+    session = main.Session(writer)
+    await main.session_command(line, session)
+    await session.flush()
+    return writer.output()
@@ -0,0 +1,29 @@
+import hal
+from conftest import command
+
+
+def test_handler_exception_is_answered(workdir):
+    commands = hal.load("commands")
+    metrics = hal.load("metrics").metrics
+    dispatcher = commands.Dispatcher()
+
+    @dispatcher.command("fail")
+    def cmd_fail(args, writer):
+        raise ValueError("bad argument")
+
+    @dispatcher.command("ok")
+    def cmd_ok(args, writer):
+        writer.write("ok\n")
+
+    writer = hal.StreamWriter()
+    errors = metrics.counter("cmd_errors").value
+    assert dispatcher.dispatch("fail; ok", writer) == 0
+    assert writer.output() == "Invalid command: bad argument\nok\n"
+    assert metrics.counter("cmd_errors").value == errors + 1
+
+
+def test_water_invalid_duration(device, loop):
+    out = loop.run_until_complete(command(device, "water herbs 1.2.3; info herbs"))
+    assert out.startswith("Invalid command")
+    assert "Domain \"herbs\" is using GPIO 0" in out
+    assert not device.ws.domains["herbs"].is_running()
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import os
+
+import hal
+import pytest
+
+from conftest import CONFIG
+
+
+@pytest.mark.parametrize("patch", [
+    {"pumps": 5},
+    {"pumps": {"max_running": "2"}},
+    {"persist": {"bogus": 1}},
+    {"log": {"level": "loud"}},
+    {"history_size": 0},
+    {"history_size": -5},
+    {"server": {"max_sessions": "4"}},
+    {"server": {"bogus": 1}},
+    {"uart": {"baudrate": 0}},
+    {"usb": {"enabled": "no"}},
+    {"sensor_interval": "x"},
+])
+def test_invalid_settings_patch(device, patch):
+    ws = device.ws
+    before = ws.config()
+    assert ws.patch_config(json.dumps(patch)) == "Failed to patch configuration"
+    assert ws.config() == before
+    assert not os.path.exists("config.patch")
+    resp = json.loads("".join(device.api.handle(json.dumps({"cmd": "patch_config", "patch": patch}))))
+    assert resp == {"ok": False, "error": "invalid patch"}
+
+
+def test_invalid_settings_update(device):
+    ws = device.ws
+    before = ws.config()
+    assert ws.update_config(json.dumps(dict(CONFIG, persist={"bogus": 1}))) == "Failed to update configuration"
+    assert ws.config() == before
+
+
+def test_valid_settings_patch(device):
+    ws = device.ws
+    assert ws.patch_config('{"pumps": {"max_running": 2}, "history_size": 50}').startswith("Successfully")
+    assert ws.queue.max_running == 2
+    assert ws.history.capacity == 50
+
+
+def test_update_stops_replaced_domains(device, loop):
+    ws = device.ws
+    herbs = ws.domains["herbs"]
+
+    async def scenario():
+        ws.water_domain("herbs")
+        ws.water_domain("bonsai")
+        await asyncio.sleep(1)
+        assert ws.update_config(json.dumps(CONFIG)).startswith("Successfully")
+        assert not herbs.is_running()
+        assert not ws.queue.running and not ws.queue.pending
+        # The new domain can water, and the old task ending doesn't touch it
+        assert "Started" in ws.water_domain("herbs")
+        await asyncio.sleep(1)
+        assert ws.domains["herbs"].is_running()
+        assert [j.domain for j in ws.queue.running] == [ws.domains["herbs"]]
+
+    loop.run_until_complete(scenario())
+
+
+def test_patch_stops_domain_moved_to_another_pin(device, loop):
+    ws = device.ws
+    herbs = ws.domains["herbs"]
+
+    async def scenario():
+        ws.water_domain("herbs")
+        await asyncio.sleep(1)
+        assert ws.patch_config('{"domains": {"herbs": {"gpio": 7}}}').startswith("Successfully")
+        assert not herbs.is_running()
+        assert herbs.pump.value() == 0
+        assert not ws.queue.running
+        await asyncio.sleep(1)
+        assert not ws.queue.running
+
+    loop.run_until_complete(scenario())
+
+
+def test_compaction_keeps_source_config(device, monkeypatch):
+    pump = hal.load("pump")
+    monkeypatch.setattr(pump, "PATCH_COMPACT_SIZE", 200)
+    ws = device.ws
+    with open("config.json") as f:
+        source = json.load(f)
+    source["domains"][1]["note"] = "kept"
+    with open("config.json", "w") as f:
+        json.dump(source, f)
+    for duration in range(1, 10):
+        assert ws.patch_config(json.dumps({"domains": {"herbs": {"duration": duration}}})).startswith("Successfully")
+    assert os.path.getsize("config.patch") < 200
+    with open("config.json") as f:
+        config = json.load(f)
+    (herbs, bonsai) = config["domains"]
+    assert herbs["schedule"] == CONFIG["domains"][0]["schedule"]
+    assert bonsai == dict(CONFIG["domains"][1], note="kept")
+    # The folded patches and the ones since then are all applied at boot
+    assert pump.WateringSystem("config.json").domains["herbs"].duration == 9
+
+
+def test_patch_with_invalid_pin_changes_nothing(device, loop, monkeypatch):
+    ws = device.ws
+    pump = hal.load("pump")
+    herbs = ws.domains["herbs"]
+    Pin = pump.Pin
+
+    def checked_pin(id, *args, **kwargs):
+        if id > 29:
+            raise ValueError("invalid pin")
+        return Pin(id, *args, **kwargs)
+
+    monkeypatch.setattr(pump, "Pin", checked_pin)
+
+    async def scenario():
+        ws.water_domain("herbs")
+        await asyncio.sleep(1)
+        before = ws.config()
+        patch = {"domains": {"herbs": {"gpio": 5}, "new": {"gpio": 99, "duration": 5, "schedule": []}}}
+        assert ws.apply_patch(patch) is None
+        assert ws.config() == before
+        assert ws.domains["herbs"] is herbs and herbs.is_running()
+
+    loop.run_until_complete(scenario())
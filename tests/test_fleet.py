@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+import fleet
+
+
+def test_batch_request(device, real_loop):
+    async def scenario():
+        server = await sys.modules["uasyncio"].start_server(device.serve_client, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        f = fleet.Fleet([fleet.Device("127.0.0.1", port)])
+        try:
+            (resp,) = await f.run([{"cmd": "time"}, {"cmd": "queue"}])
+            (single,) = await f.run({"cmd": "time"})
+        finally:
+            f.close()
+            server.close()
+        return (resp, single)
+
+    (resp, single) = real_loop.run_until_complete(scenario())
+    assert [r["ok"] for r in resp] == [True, True]
+    assert fleet.is_ok(resp) and fleet.is_ok(single)
+    assert "FAILED" not in fleet.format_results([fleet.Device("d")], [resp])
+
+
+def test_status_of_large_device(large_device, real_loop):
+    async def scenario():
+        server = await sys.modules["uasyncio"].start_server(large_device.serve_client, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        f = fleet.Fleet([fleet.Device("127.0.0.1", port)])
+        try:
+            return await f.status()
+        finally:
+            f.close()
+            server.close()
+
+    (row,) = real_loop.run_until_complete(scenario())
+    assert row[1] == "Large" and row[4] == "300" and row[-1] == ""
+
+
+@pytest.mark.parametrize("req, attempts", [
+    ([{"cmd": "time"}, {"cmd": "info"}], 3),
+    ([{"cmd": "time"}, {"cmd": "water", "domain": "herbs"}], 1),
+    ({"cmd": "water", "domain": "herbs"}, 1),
+])
+def test_batch_retry_safety(real_loop, monkeypatch, req, attempts):
+    opened = []
+
+    async def fail_open(conn):
+        opened.append(conn)
+        raise OSError("refused")
+
+    monkeypatch.setattr(fleet.Connection, "open", fail_open)
+    f = fleet.Fleet([fleet.Device("127.0.0.1", 1)], retries=2, backoff=0)
+    (resp,) = real_loop.run_until_complete(f.run(req))
+    assert resp == {"ok": False, "error": "refused"}
+    assert len(opened) == attempts
+
+
+def test_invalid_batch(real_loop):
+    f = fleet.Fleet([fleet.Device("127.0.0.1", 1)])
+    (resp,) = real_loop.run_until_complete(f.run([{"cmd": "time"}, 3]))
+    assert not resp["ok"]
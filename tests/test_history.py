@@ -0,0 +1,25 @@
+import hal
+import pytest
+
+
+@pytest.fixture
+def history(workdir):
+    return hal.load("history")
+
+
+def test_capacity_must_be_positive(history):
+    with pytest.raises(ValueError):
+        history.History("history.bin", 0)
+
+
+@pytest.mark.parametrize("capacity", [3, 10])
+def test_resize_keeps_newest_records(history, capacity):
+    h = history.History("history.bin", 5)
+    for i in range(8):
+        h.append("herbs", i + 1, history.SOURCE_MANUAL, t=1000 + i)
+    h = history.History("history.bin", capacity)
+    times = [t for (t, did, duration, source) in h.records(n=100)]
+    assert times == [1007, 1006, 1005, 1004, 1003][:capacity]
+    h.append("herbs", 1, history.SOURCE_MANUAL, t=2000)
+    assert next(h.records(n=1))[0] == 2000
+    assert h.count == min(capacity, 6)
@@ -0,0 +1,49 @@
+import asyncio
+
+
+def test_water_again_after_stop(device, loop):
+    ws = device.ws
+    bonsai = ws.domains["bonsai"]
+
+    async def scenario():
+        ws.water_domain("bonsai")
+        await asyncio.sleep(1)
+        assert "Stopped" in ws.stop_domain("bonsai")
+        assert not bonsai.is_running()
+        assert "Started" in ws.water_domain("bonsai")
+        # The cancelled task ending doesn't turn off or release the new watering
+        await asyncio.sleep(1)
+        assert bonsai.is_running()
+        assert bonsai.pump.value() == 1
+        assert [j.domain.name for j in ws.queue.running] == ["bonsai"]
+        await asyncio.sleep(5)
+        assert not bonsai.is_running()
+        assert bonsai.pump.value() == 0
+        assert not ws.queue.running
+
+    loop.run_until_complete(scenario())
+
+
+def test_record_failure_frees_queue(device, loop, monkeypatch):
+    ws = device.ws
+
+    def fail(*args):
+        raise OSError("flash full")
+
+    monkeypatch.setattr(ws.history, "append", fail)
+
+    async def scenario():
+        ws.water_domain("bonsai")
+        assert "Queued" in ws.water_domain("herbs")
+        await asyncio.sleep(6)
+        # The failed recording of bonsai let herbs start
+        assert not ws.domains["bonsai"].is_running()
+        # and only lost the history record
+        assert ws.store.get("lw:bonsai") == list(ws.domains["bonsai"].last_watered)
+        assert list(ws.usage_totals("bonsai", 1)) == [("bonsai", 1, 5, None)]
+        assert [j.domain.name for j in ws.queue.running] == ["herbs"]
+        await asyncio.sleep(20)
+        assert not ws.queue.running and not ws.queue.pending
+        assert "Started" in ws.water_domain("bonsai")
+
+    loop.run_until_complete(scenario())
@@ -0,0 +1,28 @@
+import asyncio
+
+import hal
+
+
+def test_one_heap_entry_per_domain(device, loop):
+    ws = device.ws
+    scheduler = device.scheduler
+    herbs = ws.domains["herbs"]
+    now = int(hal.clock.now) // 60
+
+    async def scenario():
+        scheduler.rebuild()
+        # bonsai has no schedule, herbs is due now (12:00)
+        assert scheduler.heap == [(now, "herbs")]
+        scheduler.fire(now)
+        assert herbs.is_running()
+        # Its following slot replaces it
+        assert scheduler.heap == [(now + 30, "herbs")]
+        # A jump of the clock past several slots runs the missed watering once
+        herbs.stop()
+        herbs.missed = "run"
+        scheduler.fire(now + 95)
+        assert herbs.is_running()
+        assert scheduler.heap == [(now + 120, "herbs")]
+        herbs.stop()
+
+    loop.run_until_complete(scenario())
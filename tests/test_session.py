@@ -0,0 +1,66 @@
+import json
+
+import hal
+
+
+def serve(device, loop, handler, lines):
+    reader = hal.StreamReader("".join(line + "\n" for line in lines).encode())
+    writer = hal.StreamWriter()
+    loop.run_until_complete(handler(reader, writer))
+    return writer.output()
+
+
+def test_session_survives_failing_output(device, loop, monkeypatch):
+    bonsai = device.ws.domains["bonsai"]
+
+    def info_lines():
+        yield "bonsai\n"
+        raise RuntimeError("broken")
+
+    monkeypatch.setattr(type(bonsai), "info_lines", lambda d: info_lines() if d is bonsai else iter(()))
+    out = serve(device, loop, device.serve_client, ["info", "water herbs 1.2.3", "print_time", "quit"])
+    assert "bonsai\nError: RuntimeError('broken')\n" in out
+    assert "Invalid command" in out
+    assert "Current Time" in out
+
+
+def test_api_session_survives_failing_request(device, loop, monkeypatch):
+    def state(d):
+        raise RuntimeError("broken")
+
+    monkeypatch.setattr(type(device.ws.domains["herbs"]), "state", state)
+    out = serve(device, loop, device.serve_api, ['{"cmd": "info"}', '{"cmd": "time", "id": 2}'])
+    (info, t) = [json.loads(line) for line in out.splitlines()]
+    assert not info["ok"] and "broken" in info["error"]
+    assert t["ok"] and t["id"] == 2
+
+
+def test_large_api_responses(large_device, loop):
+    requests = ['{"cmd": "info"}', '{"cmd": "config"}', '[{"cmd": "time"}, {"cmd": "info"}]',
+                '{"cmd": "history", "n": 1000}']
+    out = serve(large_device, loop, large_device.serve_api, requests)
+    lines = out.splitlines()
+    assert len(lines) == len(requests)
+    (info, config, batch, history) = [json.loads(line) for line in lines]
+    assert len(lines[0]) > 32768
+    assert info["ok"] and len(info["domains"]) == 300
+    assert config["ok"] and len(config["config"]["domains"]) == 300
+    assert [r["ok"] for r in batch] == [True, True] and len(batch[1]["domains"]) == 300
+    assert history == {"ok": True, "history": []}
+
+
+def test_api_stream_failure_is_json(large_device, loop, monkeypatch):
+    broken = large_device.ws.domains["domain-150"]
+    state = type(broken).state
+
+    def fail(d):
+        if d is broken:
+            raise RuntimeError("broken")
+        return state(d)
+
+    monkeypatch.setattr(type(broken), "state", fail)
+    out = serve(large_device, loop, large_device.serve_api, ['{"cmd": "info", "id": 1}', '{"cmd": "time"}'])
+    (info, t) = [json.loads(line) for line in out.splitlines()]
+    assert not info["ok"] and "broken" in info["error"] and info["id"] == 1
+    assert len(info["domains"]) == 150
+    assert t["ok"]
@@ -0,0 +1,16 @@
+import hal
+
+
+def test_torn_journal_line(workdir):
+    store = hal.load("store")
+    with open("state.log", "w") as f:
+        f.write('{"a": 1}\n{"b": 2')
+    s = store.Store()
+    assert s.state == {"a": 1}
+    s.set("c", 3)
+    s.flush()
+    s.set("d", 4)
+    s.flush()
+    # The entries written after the incomplete line survive a reboot
+    s = store.Store()
+    assert s.state == {"a": 1, "c": 3, "d": 4}
@@ -0,0 +1,23 @@
+import pytest
+
+import hal
+
+
+@pytest.fixture
+def terminal(workdir):
+    return hal.load("terminal")
+
+
+def test_undecodable_line_is_dropped(terminal, loop):
+    uart = hal.load("machine").UART(0)
+    term = terminal.Terminal(uart, echo=False)
+    # An incomplete UTF-8 sequence is left after the backspace
+    uart.feed(b"caf\xc3\xa9\x08\rinfo\rhelp\r")
+
+    async def scenario():
+        with pytest.raises(UnicodeError):
+            await term.readline()
+        assert await term.readline() == "info"
+        assert await term.readline() == "help"
+
+    loop.run_until_complete(scenario())
@@ -0,0 +1,51 @@
+import asyncio
+import json
+
+import hal
+
+
+def test_colliding_names_kept_apart(device, loop):
+    # Names that shared a 16 bit hash, and names that shared their first 32 bytes
+    names = ["domain282", "domain452", "x" * 32 + "a", "x" * 32 + "b"]
+    ws = device.ws
+    patch = {"domains": dict((name, {"gpio": 3 + i, "duration": 1 + i}) for (i, name) in enumerate(names))}
+    assert ws.patch_config(json.dumps(patch)).startswith("Successfully")
+
+    async def scenario():
+        for name in names:
+            ws.water_domain(name)
+            await asyncio.sleep(5)
+
+    loop.run_until_complete(scenario())
+    for (i, name) in enumerate(names):
+        assert list(ws.usage_totals(name, 1)) == [(name, 1, 1 + i, None)]
+        assert [(n, duration) for (t, n, duration, source) in ws.history_entries(name)] == [(name, 1 + i)]
+    ws.store.flush()
+    # The records are found again after a reboot
+    ws = hal.load("pump").WateringSystem("config.json")
+    for (i, name) in enumerate(names):
+        assert list(ws.usage_totals(name, 1)) == [(name, 1, 1 + i, None)]
+        assert [n for (t, n, duration, source) in ws.history_entries(name)] == [name]
+
+
+def test_usage_kept_by_name(workdir):
+    usage = hal.load("usage")
+    u = usage.Usage("usage.bin")
+    u.get("domain282").record(100, 10)
+    u.get("domain452").record(100, 20)
+    u.checkpoint()
+    u = usage.Usage("usage.bin")
+    assert u.get("domain282").total(100, 1) == (1, 10)
+    assert u.get("domain452").total(100, 1) == (1, 20)
+    assert u.get("domain0").total(100, 1) == (0, 0)
+
+
+def test_torn_names_file(workdir):
+    names = hal.load("names")
+    with open("names.txt", "w") as f:
+        f.write('"herbs"\n"bon')
+    n = names.Names()
+    assert n.get("herbs") == 0 and n.get("bon") is None
+    assert n.id("bonsai") == 1
+    n = names.Names()
+    assert (n.name(0), n.name(1)) == ("herbs", "bonsai")
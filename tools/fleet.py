@@ -0,0 +1,280 @@
+"""
+Run commands on a fleet of watering system boards.
+
+Connects to the command port (31415) of every device in an inventory, switches
+the session to the json lines protocol with the "api" command and sends the
+same request to all devices concurrently.  Connections are kept open and reused
+between requests, at most --parallel devices are talked to at a time, and
+requests that are safe to repeat are retried with backoff after a failure.
+
+    python tools/fleet.py devices.json status
+    python tools/fleet.py devices.json push-config pico/config.json
+    python tools/fleet.py devices.json push-config patch.json --patch
+    python tools/fleet.py devices.json sync-time
+    python tools/fleet.py devices.json run '{"cmd": "history", "n": 3}'
+    python tools/fleet.py devices.json run '[{"cmd": "time"}, {"cmd": "queue"}]'
+
+The inventory is a json list of "host[:port]" strings or {"name": ..., "host": ...,
+"port": ...} objects, or a text file with one "host[:port] [name]" per line.
+"""
+import argparse
+import asyncio
+import calendar
+import json
+import sys
+import time
+
+PORT = 31415
+
+# Longest response line read, e.g. the info of a device with hundreds of domains
+LINE_LIMIT = 1 << 24
+
+# Requests that can be sent again when the answer was lost, i.e. everything
+# except starting a watering
+NOT_RETRIED = ("water",)
+
+
+class DeviceError(Exception):
+    pass
+
+
+class Device:
+    def __init__(self, host, port=PORT, name=None):
+        self.host = host
+        self.port = port
+        self.name = name or "{}:{}".format(host, port)
+
+
+def read_inventory(filename):
+    """List of Devices from an inventory file"""
+    with open(filename) as f:
+        text = f.read()
+    try:
+        entries = json.loads(text)
+    except ValueError:
+        entries = []
+        for line in text.splitlines():
+            fields = line.split("#")[0].split()
+            if fields:
+                entries.append({"address": fields[0], "name": fields[1] if len(fields) > 1 else None})
+    devices = []
+    for e in entries:
+        if isinstance(e, str):
+            e = {"address": e}
+        if "address" in e:
+            (host, _, port) = e["address"].partition(":")
+            e = dict(e, host=host, port=int(port) if port else PORT)
+        devices.append(Device(e["host"], e.get("port", PORT), e.get("name")))
+    return devices
+
+
+class Connection:
+    """One json lines session with a device over its command port"""
+    def __init__(self, device, timeout):
+        self.device = device
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.next_id = 1
+
+    async def open(self):
+        (self.reader, self.writer) = await asyncio.wait_for(
+            asyncio.open_connection(self.device.host, self.device.port, limit=LINE_LIMIT), self.timeout)
+        # Skip the banner up to the prompt, then switch to the json lines protocol
+        while True:
+            line = await self.readline()
+            if line.startswith("Too many sessions"):
+                raise DeviceError("too many sessions")
+            if line.startswith("Enter a command"):
+                break
+        self.writer.write(b"api\n")
+        while True:
+            line = await self.readline()
+            if line.startswith("{") and json.loads(line).get("api"):
+                break
+
+    async def readline(self):
+        line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        if not line:
+            raise DeviceError("connection closed")
+        return line.decode(errors="replace").strip()
+
+    async def request(self, req):
+        """Send a request, or a list of requests answered with a list of responses"""
+        batch = isinstance(req, list)
+        reqs = [dict(r, id=self.next_id) for r in (req if batch else [req])]
+        self.next_id += 1
+        self.writer.write(json.dumps(reqs if batch else reqs[0]).encode() + b"\n")
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+        while True:
+            resp = json.loads(await self.readline())
+            # Responses to requests that timed out earlier are skipped
+            first = resp[0] if batch and isinstance(resp, list) and resp else resp
+            if isinstance(first, dict) and first.get("id") == reqs[0]["id"] and isinstance(resp, list) == batch:
+                return resp
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+
+class Fleet:
+    """Pool of connections to the devices of an inventory"""
+    def __init__(self, devices, parallel=8, timeout=5, retries=2, backoff=0.5):
+        self.devices = devices
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.slots = asyncio.Semaphore(parallel)
+        self.connections = {}
+        self.locks = {}
+
+    async def request(self, device, req):
+        """Send a request or a list of requests (or a function of the device returning one,
+           called right before it is sent) to one device and return its response,
+           reconnecting and retrying after a failure; errors are returned as
+           {"ok": false, "error": ...}"""
+        lock = self.locks.setdefault(device.name, asyncio.Lock())
+        async with self.slots, lock:
+            attempts = self.retries + 1
+            for attempt in range(attempts):
+                r = req(device) if callable(req) else req
+                items = r if isinstance(r, list) else [r]
+                if not items or [x for x in items if not isinstance(x, dict)]:
+                    return {"ok": False, "error": "a request must be an object or a non-empty list of objects"}
+                # A batch is only sent again if all of its requests are safe to repeat
+                if [x for x in items if x.get("cmd") in NOT_RETRIED]:
+                    attempts = 1
+                conn = self.connections.get(device.name)
+                try:
+                    if conn is None:
+                        conn = Connection(device, self.timeout)
+                        self.connections[device.name] = conn
+                        await conn.open()
+                    return await conn.request(r)
+                except (OSError, asyncio.TimeoutError, ValueError, DeviceError) as e:
+                    conn.close()
+                    del self.connections[device.name]
+                    error = str(e) or e.__class__.__name__
+                if attempt + 1 >= attempts:
+                    break
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+        return {"ok": False, "error": error}
+
+    async def run(self, req):
+        """Send a request to all devices concurrently, return the responses in inventory order"""
+        return await asyncio.gather(*[self.request(d, req) for d in self.devices])
+
+    async def status(self):
+        """Rows of the status table of all devices"""
+        infos = await self.run({"cmd": "info"})
+        rows = []
+        for (d, info) in zip(self.devices, infos):
+            if not info.get("ok"):
+                rows.append([d.name, "", "", "", "", "", "", info.get("error", "")])
+                continue
+            domains = info["domains"]
+            running = [x["name"] for x in domains if x.get("running")]
+            last = [x["last_watered"] for x in domains if x.get("last_watered")]
+            rows.append([d.name, info["name"], format_time(info["time"]), "{:+d}".format(clock_skew(info["time"])),
+                         str(len(domains)), ",".join(running) or "-", format_time(max(last)) if last else "-", ""])
+        return rows
+
+    async def push_config(self, config, patch=False):
+        if patch:
+            return await self.run({"cmd": "patch_config", "patch": config})
+        return await self.run({"cmd": "update_config", "config": config})
+
+    async def sync_time(self):
+        """Set the clock of all devices to the local time of this computer"""
+        return await self.run(lambda d: {"cmd": "set_time", "time": list(time.localtime()[:5])})
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections.clear()
+
+
+def clock_skew(device_time):
+    """Seconds the device clock (a localtime list) is ahead of the local clock"""
+    return calendar.timegm(tuple(device_time[:6]) + (0, 0, 0)) - calendar.timegm(time.localtime()[:6] + (0, 0, 0))
+
+
+def format_time(t):
+    return "{:04}-{:02}-{:02} {:02}:{:02}".format(*t[:5])
+
+
+def format_table(headers, rows):
+    widths = [max(len(str(r[i])) for r in [headers] + rows) for i in range(len(headers))]
+    lines = ["  ".join(str(v).ljust(w) for (v, w) in zip(r, widths)).rstrip() for r in [headers] + rows]
+    lines.insert(1, "  ".join("-" * w for w in widths))
+    return "\n".join(lines)
+
+
+def is_ok(resp):
+    """True if a response, or all the responses to a list of requests, are ok"""
+    if isinstance(resp, list):
+        return all(r.get("ok") for r in resp)
+    return bool(resp.get("ok"))
+
+
+def format_results(devices, responses):
+    """Table of the result of a command on every device"""
+    rows = []
+    for (d, resp) in zip(devices, responses):
+        items = resp if isinstance(resp, list) else [resp]
+        details = [dict((k, v) for (k, v) in r.items() if k not in ("ok", "id", "error")) for r in items]
+        errors = [r["error"] for r in items if r.get("error")]
+        detail = "; ".join(errors) or json.dumps(details if isinstance(resp, list) else details[0])
+        rows.append([d.name, "ok" if is_ok(resp) else "FAILED", detail])
+    return format_table(["device", "result", "detail"], rows)
+
+
+async def run_command(fleet, args):
+    """Run the command given on the command line, return the text to print and the exit status"""
+    if args.command == "status":
+        rows = await fleet.status()
+        failed = sum(1 for r in rows if r[-1])
+        return (format_table(["device", "name", "time", "skew", "domains", "running", "last watered", "error"], rows), 1 if failed else 0)
+    if args.command == "push-config":
+        with open(args.args[0]) as f:
+            config = json.load(f)
+        responses = await fleet.push_config(config, args.patch)
+    elif args.command == "sync-time":
+        responses = await fleet.sync_time()
+    elif args.command == "run":
+        responses = await fleet.run(json.loads(args.args[0]))
+    else:
+        raise SystemExit("Unknown command {}".format(args.command))
+    return (format_results(fleet.devices, responses), 0 if all(is_ok(r) for r in responses) else 1)
+
+
+async def amain(args):
+    fleet = Fleet(read_inventory(args.inventory), args.parallel, args.timeout, args.retries)
+    try:
+        return await run_command(fleet, args)
+    finally:
+        fleet.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("inventory", help="inventory file of the devices")
+    parser.add_argument("command", choices=["status", "push-config", "sync-time", "run"])
+    parser.add_argument("args", nargs="*", help="config file for push-config, json request for run")
+    parser.add_argument("--patch", action="store_true", help="push-config sends a patch_config patch")
+    parser.add_argument("--parallel", type=int, default=8, help="devices talked to at the same time")
+    parser.add_argument("--timeout", type=float, default=5, help="seconds to wait for a device")
+    parser.add_argument("--retries", type=int, default=2, help="retries after a failed request")
+    args = parser.parse_args(argv)
+    if args.command in ("push-config", "run") and len(args.args) != 1:
+        parser.error("{} takes one argument".format(args.command))
+    (text, status) = asyncio.run(amain(args))
+    print(text)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())